@@ -1,15 +1,51 @@
 #! /usr/bin/env python
 
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import contextlib
 import inkex
+import io
+import multiprocessing.util
 import os
+import queue
+import re
+import struct
 import subprocess
+import sys
+import threading
+import time
+import unicodedata
 import tempfile
 import copy
+import hashlib
+import itertools
 import logging
 import json
+import zlib
+from xml.sax.saxutils import quoteattr
 from lxml import etree
-from inkex import BaseElement, Use, Layer, Group
+from inkex import BaseElement, Use, Layer, Group, Symbol, Transform
+
+# Optional, for the native PNG export engine
+try:
+    import cairosvg
+except (ImportError, OSError):
+    # OSError when the cairo library is missing
+    cairosvg = None
+
+# Optional, for the atlas export
+try:
+    from PIL import Image, PngImagePlugin
+
+    # Chunks of each decoded PNG would fill the log
+    logging.getLogger("PIL").setLevel(logging.INFO)
+except ImportError:
+    Image = None
+
+# Optional, for the PNG trim
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 # TODO Improve tests
@@ -21,7 +57,8 @@ def user_error(title, msg):
 
 
 def is_clone(element):
-    if element == None:
+    # Images, gradients or text paths also have a href
+    if not isinstance(element, Use):
         return False
     ref_attrib_name = "{%s}href" % element.nsmap["xlink"]
     return ref_attrib_name in element.attrib
@@ -33,13 +70,39 @@ def get_name_element(element):
     return element.get("inkscape:label", "")
 
 
-# Get hierarchy names (including self)
-def get_element_hierarchy(element):
-    return list(
-        filter(
-            None, map(get_name_element, reversed([element] + list(element.ancestors())))
-        )
-    )
+# RAM backed folder, for the temporary layer documents
+MEMORY_FOLDER = "/dev/shm"
+
+
+def write_temporary_document(data, in_memory=False):
+    """Path of a temporary SVG document, to be removed by the caller"""
+    folders = [None]
+    if in_memory and os.path.isdir(MEMORY_FOLDER) and os.access(MEMORY_FOLDER, os.W_OK):
+        folders.insert(0, MEMORY_FOLDER)
+
+    for folder in folders:
+        path = None
+        try:
+            handle, path = tempfile.mkstemp(suffix=".svg", dir=folder)
+            with os.fdopen(handle, "wb") as temporary_file:
+                temporary_file.write(data)
+            return path
+        except OSError as error:
+            # Not left behind when the memory folder is full
+            if path != None:
+                os.remove(path)
+            if folder == folders[-1]:
+                raise
+            logging.debug("  Fallback to temporary folder: {}".format(error))
+
+
+# Translate "--name=value" command options into "name:value" shell actions
+def command_to_actions(command):
+    actions = []
+    for argument in command[1:]:
+        name, _, value = argument.removeprefix("--").partition("=")
+        actions.append("{}:{}".format(name, value) if value else name)
+    return actions
 
 
 class Options:
@@ -54,7 +117,26 @@ class Options:
         self.export_pdf_version = batch_exporter.options.export_pdf_version
         self.output_path = os.path.normpath(batch_exporter.options.path)
         self.overwrite_files = self._str_to_bool(batch_exporter.options.overwrite_files)
+        self.case_insensitive_paths = self._str_to_bool(
+            batch_exporter.options.case_insensitive_paths
+        )
         self.export_manifest = self._str_to_bool(batch_exporter.options.export_manifest)
+        self.compact_manifest = self._str_to_bool(
+            batch_exporter.options.compact_manifest
+        )
+        self.use_cache = self._str_to_bool(batch_exporter.options.use_cache)
+        self.resume = self._str_to_bool(batch_exporter.options.resume)
+        self.dry_run = self._str_to_bool(batch_exporter.options.dry_run)
+        self.trim_png = self._str_to_bool(batch_exporter.options.trim_png)
+        self.trim_padding = batch_exporter.options.trim_padding
+        self.optimize_png = self._str_to_bool(batch_exporter.options.optimize_png)
+        self.optimize_palette = self._str_to_bool(
+            batch_exporter.options.optimize_palette
+        )
+        self.export_atlas = self._str_to_bool(batch_exporter.options.export_atlas)
+        self.atlas_size = batch_exporter.options.atlas_size
+        self.atlas_padding = batch_exporter.options.atlas_padding
+        self.atlas_trim = self._str_to_bool(batch_exporter.options.atlas_trim)
 
         # Controls page
         self.using_clones = self._str_to_bool(batch_exporter.options.using_clones)
@@ -70,6 +152,8 @@ class Options:
         self.child_layers_visible = self._str_to_bool(
             batch_exporter.options.child_layers_visible
         )
+        self.variant_prefix = batch_exporter.options.variant_prefix
+        self.variant_frames = batch_exporter.options.variant_frames
 
         # Export size page
         self.export_area_type = batch_exporter.options.export_area_type
@@ -78,6 +162,10 @@ class Options:
         self.export_res_dpi = batch_exporter.options.export_res_dpi
         self.export_res_width = batch_exporter.options.export_res_width
         self.export_res_height = batch_exporter.options.export_res_height
+        self.export_res_list = batch_exporter.options.export_res_list
+        self.resolutions = []
+        if self.export_res_type == "list":
+            self.resolutions = Resolution.parse_list(self.export_res_list)
 
         # File naming page
         self.hierarchy_separator = batch_exporter.options.hierarchy_separator
@@ -94,13 +182,23 @@ class Options:
         # Threads page
         self.number_threads = batch_exporter.options.number_threads
         self.chunks_size = batch_exporter.options.chunks_size
+        self.scheduling = batch_exporter.options.scheduling
+        self.export_engine = batch_exporter.options.export_engine
+        self.pool_type = batch_exporter.options.pool_type
+        self.export_transport = batch_exporter.options.export_transport
+        self.export_timeout = batch_exporter.options.export_timeout
+        self.export_retries = batch_exporter.options.export_retries
+        self.retry_backoff = batch_exporter.options.retry_backoff
 
         # Help page
         self.use_logging = self._str_to_bool(batch_exporter.options.use_logging)
+        self.log_file = None
+        self.export_timings = self._str_to_bool(batch_exporter.options.export_timings)
+        self.log_path = os.path.expanduser(batch_exporter.options.log_path)
+        self.overwrite_log = self._str_to_bool(batch_exporter.options.overwrite_log)
         if self.use_logging:
-            self.log_path = os.path.expanduser(batch_exporter.options.log_path)
-            self.overwrite_log = self._str_to_bool(batch_exporter.options.overwrite_log)
             log_file_name = os.path.join(self.log_path, "batch_export.log")
+            self.log_file = log_file_name
             if self.overwrite_log and os.path.exists(log_file_name):
                 logging.basicConfig(
                     filename=log_file_name, filemode="w", level=logging.DEBUG
@@ -117,7 +215,20 @@ class Options:
         print += "Export PDF version: {}\n".format(self.export_pdf_version)
         print += "Path: {}\n".format(self.output_path)
         print += "Overwrite files: {}\n".format(self.overwrite_files)
+        print += "Case insensitive paths: {}\n".format(self.case_insensitive_paths)
         print += "Export manifest JSON: {}\n".format(self.export_manifest)
+        print += "Compact manifest: {}\n".format(self.compact_manifest)
+        print += "Use cache: {}\n".format(self.use_cache)
+        print += "Resume: {}\n".format(self.resume)
+        print += "Dry run: {}\n".format(self.dry_run)
+        print += "Trim PNG: {}\n".format(self.trim_png)
+        print += "Trim padding: {}\n".format(self.trim_padding)
+        print += "Optimize PNG: {}\n".format(self.optimize_png)
+        print += "Optimize palette: {}\n".format(self.optimize_palette)
+        print += "Export atlas: {}\n".format(self.export_atlas)
+        print += "Atlas size: {}\n".format(self.atlas_size)
+        print += "Atlas padding: {}\n".format(self.atlas_padding)
+        print += "Atlas trim: {}\n".format(self.atlas_trim)
         print += "\n======> Controls page\n"
         print += "Using clones: {}\n".format(self.using_clones)
         print += "Skip hidden layers: {}\n".format(self.skip_hidden_layers)
@@ -126,6 +237,8 @@ class Options:
         print += "Ignore prefix: {}\n".format(self.ignore_prefix)
         print += "Use ignored name (no prefix): {}\n".format(self.use_ignored_name)
         print += "Child layers always visible: {}\n".format(self.child_layers_visible)
+        print += "Variant prefix: {}\n".format(self.variant_prefix)
+        print += "Variant frames: {}\n".format(self.variant_frames)
         print += "\n======> Export size page\n"
         print += "Export area type: {}\n".format(self.export_area_type)
         print += "Export area size: {}\n".format(self.export_area_size)
@@ -133,6 +246,7 @@ class Options:
         print += "Export res DPI: {}\n".format(self.export_res_dpi)
         print += "Export res width: {}\n".format(self.export_res_width)
         print += "Export res height: {}\n".format(self.export_res_height)
+        print += "Export res list: {}\n".format(self.export_res_list)
         print += "\n======> File naming page\n"
         print += "Hierarchy separator: {}\n".format(self.hierarchy_separator)
         print += "Separator strategy: {}\n".format(self.separator_strategy)
@@ -142,24 +256,1726 @@ class Options:
         print += "\n======> Threads page\n"
         print += "Number threads: {}\n".format(self.number_threads)
         print += "Chunks size: {}\n".format(self.chunks_size)
+        print += "Scheduling: {}\n".format(self.scheduling)
+        print += "Export engine: {}\n".format(self.export_engine)
+        print += "Pool type: {}\n".format(self.pool_type)
+        print += "Export transport: {}\n".format(self.export_transport)
+        print += "Export timeout: {}\n".format(self.export_timeout)
+        print += "Export retries: {}\n".format(self.export_retries)
+        print += "Retry backoff: {}\n".format(self.retry_backoff)
         print += "\n======> Help page\n"
         print += "Use logging: {}\n".format(self.use_logging)
+        print += "Export timings: {}\n".format(self.export_timings)
         print += "Overwrite log: {}\n".format(self.overwrite_log)
         print += "Log path: {}\n".format(self.log_path)
         print += "---------------------------------------\n"
         return print
 
     def _str_to_bool(self, str):
-        if str.lower() == "true":
+        # Default values of the arguments are not strings
+        if f"{str}".lower() == "true":
             return True
         return False
 
 
+class Resolution:
+    """One resolution of the resolutions list, a DPI or a size in pixels"""
+
+    def __init__(self, name, dpi=None, width=None, height=None):
+        self.name = name
+        self.dpi = dpi
+        self.width = width
+        self.height = height
+
+    @staticmethod
+    def parse_list(resolutions_list):
+        """Parse "1x=96;2x=192;thumb=64x64", a name by DPI or size"""
+        resolutions = []
+        for entry in resolutions_list.split(";"):
+            if entry.strip() == "":
+                continue
+            name, _, value = entry.partition("=")
+            name, value = name.strip(), value.strip().lower()
+            width, _, height = value.partition("x")
+            if (
+                name == ""
+                or not width.isdigit()
+                or not (height == "" or height.isdigit())
+            ):
+                user_error(
+                    "Resolutions list",
+                    "Wrong resolution {}, expected name=DPI or name=WIDTHxHEIGHT.".format(
+                        entry
+                    ),
+                )
+            if name in [resolution.name for resolution in resolutions]:
+                user_error(
+                    "Resolutions list", "Resolution {} is given twice.".format(name)
+                )
+            if height == "":
+                resolutions.append(Resolution(name, dpi=int(width)))
+            else:
+                resolutions.append(
+                    Resolution(name, width=int(width), height=int(height))
+                )
+
+        if resolutions == []:
+            user_error("Resolutions list", "No resolution given.")
+        return resolutions
+
+    def command_arguments(self, reset=False):
+        """Reset the other arguments (0 is unset), they are kept by a shell"""
+        if self.dpi != None:
+            arguments = ["--export-dpi={}".format(self.dpi)]
+            if reset:
+                arguments += ["--export-width=0", "--export-height=0"]
+            return arguments
+        arguments = [
+            "--export-width={}".format(self.width),
+            "--export-height={}".format(self.height),
+        ]
+        if reset:
+            arguments.append("--export-dpi=0")
+        return arguments
+
+
+class NameTemplate:
+    """The name template, parsed once into the segments of each layer path"""
+
+    TAG = re.compile(r"\[([A-Z_]+)(?:([:-])(-?\d+))?((?:\|[a-z]+)*)\]")
+    FILTERS = {
+        "slug": lambda text: NameTemplate.slug(text),
+        "lower": str.lower,
+        "upper": str.upper,
+    }
+    # The path used to be replaced tag by tag, in this order after the names:
+    # a tag inside a layer or parent name is still replaced
+    NAME_TAGS = {
+        "[LAYER_NAME]": lambda name, counter, resolution: name,
+        "[NUM]": lambda name, counter, resolution: str(counter),
+        **{
+            "[NUM-{}]".format(digits): (
+                lambda name, counter, resolution, digits=digits: str(counter).zfill(
+                    digits
+                )
+            )
+            for digits in range(1, 6)
+        },
+        "[RES]": lambda name, counter, resolution: (
+            resolution.name if resolution != None else ""
+        ),
+    }
+
+    def __init__(self, options):
+        self.options = options
+        self.tags = set()
+        self.segments = []
+        # Ancestors of the layers, by hierarchy prefix
+        self.parents_cache = {}
+
+        template = options.name_template
+        position = 0
+        for match in self.TAG.finditer(template):
+            segment = self.tag_segment(*match.groups())
+            # Unknown tags stay as text
+            if segment == None:
+                continue
+            self.add_text(template[position : match.start()])
+            self.segments.append(segment)
+            self.tags.add(match.group(1))
+            position = match.end()
+        self.add_text(template[position:])
+
+    @staticmethod
+    def slug(text):
+        text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode()
+        return re.sub(r"[^a-z0-9]+", "-", text.lower()).strip("-")
+
+    def add_text(self, text):
+        if text != "":
+            self.segments.append(lambda parents, name, counter, resolution: text)
+
+    def tag_segment(self, tag, sign, number, filters):
+        # [NUM-1] to [NUM-5] came before [NUM:N]
+        if tag == "NUM" and sign == "-" and number in ["1", "2", "3", "4", "5"]:
+            sign = ":"
+
+        if tag == "NUM" and sign == ":" and not number.startswith("-"):
+            digits = int(number)
+            value = lambda parents, name, counter, resolution: str(counter).zfill(
+                digits
+            )
+        elif tag == "HIERARCHY" and sign == ":":
+            depth = int(number)
+            if depth == 0:
+                user_error(
+                    "Name template",
+                    "[HIERARCHY:0] has no layer, depths start at 1 (or -1 for the parent).",
+                )
+            index = depth - 1 if depth > 0 else depth
+            value = lambda parents, name, counter, resolution: self.ancestor(
+                parents[1], index
+            )
+        elif number != None:
+            return None
+        elif tag == "NUM":
+            value = lambda parents, name, counter, resolution: str(counter)
+        elif tag == "HIERARCHY":
+            value = lambda parents, name, counter, resolution: parents[0]
+        elif tag == "PARENT":
+            value = lambda parents, name, counter, resolution: self.ancestor(
+                parents[1], -1
+            )
+        elif tag == "LAYER_NAME":
+            value = lambda parents, name, counter, resolution: name
+        elif tag == "RES":
+            value = lambda parents, name, counter, resolution: (
+                resolution.name if resolution != None else ""
+            )
+        else:
+            return None
+
+        if tag in ("HIERARCHY", "PARENT", "LAYER_NAME"):
+            value = self.with_name_tags(value, tag == "LAYER_NAME")
+
+        for filter_name in filters.split("|")[1:]:
+            if filter_name not in self.FILTERS:
+                user_error(
+                    "Name template",
+                    "Unknown filter {} in [{}], expected {}.".format(
+                        filter_name, tag, ", ".join(self.FILTERS)
+                    ),
+                )
+            value = self.filtered(value, self.FILTERS[filter_name])
+        return value
+
+    def with_name_tags(self, value, layer_name):
+        """The tags in the names replaced, the layer name keeps its own"""
+        tags = [
+            (tag, tag_value)
+            for tag, tag_value in self.NAME_TAGS.items()
+            if not (layer_name and tag == "[LAYER_NAME]")
+        ]
+
+        def replaced(parents, name, counter, resolution):
+            text = value(parents, name, counter, resolution)
+            if "[" in text:
+                for tag, tag_value in tags:
+                    if tag in text:
+                        text = text.replace(tag, tag_value(name, counter, resolution))
+            return text
+
+        return replaced
+
+    @staticmethod
+    def filtered(value, text_filter):
+        return lambda parents, name, counter, resolution: text_filter(
+            value(parents, name, counter, resolution)
+        )
+
+    @staticmethod
+    def ancestor(names, index):
+        if -len(names) <= index < len(names):
+            return names[index]
+        return ""
+
+    def get_parents(self, layers_hierarchy):
+        """[HIERARCHY] and the ancestors names, top first"""
+        options = self.options
+        names = [
+            (
+                parent_name.removeprefix(options.ignore_prefix)
+                if options.use_ignored_name
+                or not parent_name.startswith(options.ignore_prefix)
+                else ""
+            )
+            for parent_name in layers_hierarchy
+        ]
+
+        if not options.top_hierarchy_first:
+            layers_hierarchy = list(reversed(layers_hierarchy))
+
+        # Extra separators conditions
+        add_left_sep = (layers_hierarchy != [] or options.empty_extra_separator) and (
+            options.separator_strategy == "left" or options.separator_strategy == "both"
+        )
+        add_right_sep = (layers_hierarchy != [] or options.empty_extra_separator) and (
+            options.separator_strategy == "right"
+            or options.separator_strategy == "both"
+        )
+
+        # Add an extra element to add extra separators if empty (but not if both, redundant, or none)
+        if (
+            options.empty_extra_separator
+            and layers_hierarchy == []
+            and options.separator_strategy != "both"
+            and options.separator_strategy != "none"
+        ):
+            layers_hierarchy = [""]
+        if add_left_sep:
+            layers_hierarchy = [""] + layers_hierarchy
+        if add_right_sep:
+            layers_hierarchy = layers_hierarchy + [""]
+
+        hierarchy = (options.hierarchy_separator).join(
+            [
+                parent_name.removeprefix(options.ignore_prefix)
+                for parent_name in layers_hierarchy
+                if options.use_ignored_name
+                or not parent_name.startswith(options.ignore_prefix)
+            ]
+        )
+        return hierarchy, names
+
+    def get_path(self, hierarchy, counter, resolution=None):
+        # Ignore self for hierarchy keyword
+        layers_hierarchy = tuple(hierarchy[:-1])
+        parents = self.parents_cache.get(layers_hierarchy)
+        if parents == None:
+            parents = self.get_parents(list(layers_hierarchy))
+            self.parents_cache[layers_hierarchy] = parents
+
+        path = "".join(
+            [
+                segment(parents, hierarchy[-1], counter, resolution)
+                for segment in self.segments
+            ]
+        )
+        path = "{}.{}".format(path, self.options.export_type)
+        # Special case user separator break local path
+        path = path.removeprefix("/").removeprefix("\\")
+        destination_path = os.path.join(self.options.output_path, path)
+        destination_path = os.path.normpath(destination_path)
+        return destination_path
+
+
+class ClonesResolver:
+    """Replace clones by copies of their sources, each source is prepared once"""
+
+    def __init__(self, doc):
+        self.clones = doc.xpath("//svg:use[@xlink:href]", namespaces=inkex.NSS)
+        # Clones inside each source, by source id
+        self.sources_clones = {}
+        # Prepared copies, by source id
+        self.templates = {}
+
+    def get_source_clones(self, source):
+        source_id = source.get_id()
+        if source_id not in self.sources_clones:
+            self.sources_clones[source_id] = [
+                element for element in source.iter() if is_clone(element)
+            ]
+        return self.sources_clones[source_id]
+
+    def sorted_clones(self):
+        """Clones ordered so the ones inside a source come before it is copied"""
+        order = []
+        states = {}  # False: visiting, True: done
+
+        def visit(clone, chain):
+            if states.get(clone) == True:
+                return
+            if states.get(clone) == False:
+                cycle = chain[chain.index(clone) :] + [clone]
+                user_error(
+                    "Clone cycle",
+                    "Clones are referencing themselves: {}".format(
+                        " > ".join(element.get_id() for element in cycle)
+                    ),
+                )
+            states[clone] = False
+            source = clone.href
+            if source != None:
+                for dependency in self.get_source_clones(source):
+                    visit(dependency, chain + [clone])
+            states[clone] = True
+            order.append(clone)
+
+        # Depth first, as the previous reversed document order
+        for clone in reversed(self.clones):
+            visit(clone, [])
+        return order
+
+    def get_template(self, source):
+        source_id = source.get_id()
+        if source_id not in self.templates:
+            template = source.copy()
+            if isinstance(template, Symbol):
+                group = Group(**template.attrib)
+                group.extend(template)
+                template = group
+
+            # Change layer to group when unlinking
+            for child in template.iter():
+                if Layer.is_class_element(child):
+                    child.set("inkscape:groupmode", "")
+            self.templates[source_id] = template
+        return self.templates[source_id]
+
+    def get_clone_id(self, clone):
+        # Not through get_id(), it would give a random id
+        if "id" not in clone.attrib:
+            return "clone{}".format(self.clones.index(clone))
+        return clone.attrib["id"]
+
+    def resolve(self):
+        for clone in self.sorted_clones():
+            # Sources copied before are replaced with the same id
+            source = clone.href
+            if source == None:
+                logging.debug("  Clone without source: {}".format(clone.get_id()))
+                continue
+
+            # Same as Use.unlink, from the prepared copy
+            copy = self.get_template(source).copy()
+            copy.transform = clone.transform @ copy.transform
+            copy.transform.add_translate(
+                clone.to_dimensionless(clone.get("x", 0)),
+                clone.to_dimensionless(clone.get("y", 0)),
+            )
+            copy.style = clone.style + copy.style
+            old_id = self.get_clone_id(clone)
+            clone.replace_with(copy)
+            copy.set_id(old_id)
+            # Ids from the clone and the source ones, the same on each export
+            for element in copy.iterdescendants():
+                if isinstance(element.tag, str) and "id" in element.attrib:
+                    element.attrib["id"] = "{}-{}".format(old_id, element.attrib["id"])
+
+            # Special case style
+            if float(clone.style.get("opacity", 1)) <= 0.0:
+                copy.style["opacity"] = 0
+                copy.style.update(copy.style)
+
+
+class LayerInfo:
+    """Layer found by LayerIndex, states are the ones of the walk"""
+
+    __slots__ = (
+        "element",
+        "label",
+        "parent",
+        "depth",
+        "hierarchy",
+        "hidden",
+        "children",
+        "transform",
+        "deleted",
+    )
+
+    def __init__(self, element, label, parent, depth, hierarchy, hidden, transform):
+        self.element = element
+        self.label = label
+        # Position of the closest ancestor layer, None for top layers
+        self.parent = parent
+        # Number of ancestor layers
+        self.depth = depth
+        # Names of the labelled ancestors, including self
+        self.hierarchy = hierarchy
+        self.hidden = hidden
+        # Positions of the direct child layers
+        self.children = []
+        # Composed transform of the parent element
+        self.transform = transform
+        self.deleted = False
+
+
+class LayerIndex:
+    """Layers of a document, in document order, found by a single tree walk"""
+
+    def __init__(self, doc):
+        self.layers = []
+        self.positions = {}
+
+        # Element, parent composed transform and hierarchy, closest ancestor
+        # layer position and if the parent is this layer
+        stack = [(doc.getroot(), Transform(), (), None, False)]
+        while stack:
+            element, transform, hierarchy, layer_position, in_layer = stack.pop()
+
+            label = get_name_element(element)
+            if label:
+                hierarchy = hierarchy + (label,)
+
+            if Layer.is_class_element(element):
+                parent = self.layers[layer_position] if layer_position != None else None
+                info = LayerInfo(
+                    element,
+                    label,
+                    layer_position,
+                    parent.depth + 1 if parent != None else 0,
+                    hierarchy,
+                    "display:none" in element.attrib.get("style", ""),
+                    transform,
+                )
+                layer_position = len(self.layers)
+                if in_layer:
+                    parent.children.append(layer_position)
+                self.layers.append(info)
+                self.positions[element] = layer_position
+
+            # Not through inkex get(), it would rewrite the attribute
+            if "transform" in element.attrib:
+                transform = transform @ Transform(element.attrib["transform"])
+
+            # Reversed to pop the children in document order
+            in_layer = Layer.is_class_element(element)
+            for child in reversed(element):
+                # Skip comments and processing instructions
+                if isinstance(child.tag, str):
+                    stack.append(
+                        (child, transform, hierarchy, layer_position, in_layer)
+                    )
+
+    def get(self, element):
+        return self.layers[self.positions[element]]
+
+    def delete(self, position):
+        """Delete the layer element, with the layers inside it"""
+        info = self.layers[position]
+        info.element.delete()
+        info.deleted = True
+
+        # Descendant layers are the next ones deeper in the tree
+        position += 1
+        while position < len(self.layers) and self.layers[position].depth > info.depth:
+            self.layers[position].deleted = True
+            position += 1
+
+    def existing_layers(self):
+        """Layers still in the document, in document order"""
+        return [info for info in self.layers if not info.deleted]
+
+
+class VariantFrame:
+    """Combination of states of the variant layers of a parent layer"""
+
+    def __init__(self, states, hidden, shown):
+        # State name by variant name, for the manifest
+        self.states = states
+        # Layers removed from the frame, and forced visible
+        self.hidden = hidden
+        self.shown = shown
+
+    def with_layers(self, layers):
+        """Same frame with other layers, from an element or position map"""
+        return VariantFrame(
+            self.states,
+            [layers[layer] for layer in self.hidden],
+            [layers[layer] for layer in self.shown],
+        )
+
+    def copy_layer(self, layer):
+        """Copy of the parent layer showing only the states of the frame"""
+
+        # Layers of the copy at the same place than the ones of the frame
+        def find_copy(element):
+            indexes = []
+            while element is not layer:
+                parent = element.getparent()
+                indexes.append(parent.index(element))
+                element = parent
+            element = copy_layer
+            for index in reversed(indexes):
+                element = element[index]
+            return element
+
+        copy_layer = copy.deepcopy(layer)
+        hidden = [find_copy(element) for element in self.hidden]
+        for element in self.shown:
+            find_copy(element).attrib["style"] = "display:inline"
+        for element in hidden:
+            element.getparent().remove(element)
+        return copy_layer
+
+
+class LayerDocumentSerializer:
+    """Build layer documents as bytes, the base document is serialized once"""
+
+    # Ids used by url(#id), href="#id" or lists like "#id1;#id2"
+    REFERENCE = re.compile(rb"""(?:url\(\s*(?:["']|&quot;)?|=["']|;)#([^"'()\s;&]+)""")
+
+    def __init__(self, doc):
+        # Serialize the base document around an empty layer container
+        root = doc.getroot()
+        container = Layer.new("root")
+        marker = etree.Comment("batch-export-layer")
+        container.append(marker)
+        root.append(container)
+
+        # Mark each definition, a layer document only has the ones it uses
+        definition_marker = etree.Comment("batch-export-definition")
+        defs_marker = etree.Comment("batch-export-defs")
+        markers = []
+        # Definition of each id, its descendants ids included
+        self.definitions_ids = {}
+        nb_definitions = 0
+        for defs in root.iterchildren(inkex.addNS("defs", "svg")):
+            for child in list(defs):
+                markers.append(copy.copy(definition_marker))
+                child.addprevious(markers[-1])
+                for element in child.iter():
+                    # Not through inkex get(), comments have no attributes
+                    if isinstance(element.tag, str) and "id" in element.attrib:
+                        self.definitions_ids[element.attrib["id"]] = nb_definitions
+                nb_definitions += 1
+            markers.append(copy.copy(defs_marker))
+            defs.append(markers[-1])
+
+        data = etree.tostring(doc)
+        for element in markers:
+            element.getparent().remove(element)
+        root.remove(container)
+        prefix, self.suffix = data.split(etree.tostring(marker))
+
+        # Base document parts, and the definitions between each of them
+        self.parts = []
+        self.definitions = []
+        self.defs_definitions = []
+        defs_parts = prefix.split(etree.tostring(defs_marker))
+        for defs_part in defs_parts[:-1]:
+            definitions = defs_part.split(etree.tostring(definition_marker))
+            self.parts.append(definitions[0])
+            self.defs_definitions.append(
+                range(
+                    len(self.definitions), len(self.definitions) + len(definitions) - 1
+                )
+            )
+            self.definitions += [
+                (definition, self.REFERENCE.findall(definition))
+                for definition in definitions[1:]
+            ]
+
+        # The container start tag is the end of the prefix
+        self.parts.append(defs_parts[-1].removesuffix(b">"))
+
+        # Always written: definitions without ids (styles, comments) and the
+        # ones used by the base document
+        anonymous = set(range(len(self.definitions))) - set(
+            self.definitions_ids.values()
+        )
+        self.base_definitions = self.used_definitions(
+            b"".join(self.parts) + self.suffix, anonymous
+        )
+
+    def used_definitions(self, data, definitions=()):
+        """Definitions referenced by the data, and the ones they reference"""
+        definitions = set(definitions)
+        references = self.REFERENCE.findall(data)
+        for index in definitions:
+            references += self.definitions[index][1]
+
+        while references:
+            index = self.definitions_ids.get(references.pop().decode())
+            if index != None and index not in definitions:
+                definitions.add(index)
+                references += self.definitions[index][1]
+        return definitions
+
+    def serialize(self, layer, transform=None, frame=None):
+        # Handle transform hierarchy, the parent one if not given
+        # Transform overloads ==, an identity one would equal None
+        if transform is None:
+            parent = layer.getparent()
+            transform = parent.composed_transform() if parent != None else None
+        if frame != None:
+            layer = frame.copy_layer(layer)
+
+        # Force the layer visible, only its start tag need to be changed
+        data = etree.tostring(layer, with_tail=False)
+        end = data.index(b">")
+        if data[end - 1 : end] == b"/":
+            end -= 1
+        start_tag, found = re.subn(
+            rb'(\s)style="[^"]*"', rb'\1style="display:inline"', data[:end], count=1
+        )
+        if not found:
+            start_tag += b' style="display:inline"'
+
+        # Only the definitions used, Inkscape would parse all of them
+        used = self.used_definitions(data, self.base_definitions)
+        parts = [self.parts[0]]
+        for definitions, part in zip(self.defs_definitions, self.parts[1:]):
+            parts += [
+                self.definitions[index][0] for index in definitions if index in used
+            ]
+            parts.append(part)
+
+        if transform:
+            parts.append(b" transform=" + quoteattr(str(transform)).encode())
+        parts.append(b">")
+        parts += [start_tag, data[end:]]
+
+        parts.append(self.suffix)
+        return b"".join(parts)
+
+
+class NativeRasterizer:
+    """Render PNG layer documents in process, without starting Inkscape"""
+
+    # Not handled, or not rendered as Inkscape would do
+    UNSUPPORTED_FEATURES = (
+        b"<filter",
+        b"flowRoot",
+        b"meshgradient",
+        b"<hatch",
+        b"mix-blend-mode",
+    )
+
+    def __init__(self, options: Options):
+        self.scale = 1
+        self.width = None
+        self.height = None
+
+        # Export res - default: 96 DPI, as Inkscape
+        if options.export_res_type == "dpi":
+            self.scale = options.export_res_dpi / 96
+        elif options.export_res_type == "size":
+            self.width = options.export_res_width
+            self.height = options.export_res_height
+
+    @staticmethod
+    def is_available(options: Options):
+        if cairosvg == None:
+            logging.debug("  Native engine: cairosvg can't be imported")
+            return False
+        if options.export_type != "png":
+            logging.debug("  Native engine: only for PNG export")
+            return False
+        # Drawing and custom areas need Inkscape geometry
+        if options.export_area_type != "page":
+            logging.debug("  Native engine: only for page export area")
+            return False
+        return True
+
+    def export(self, export_data, output_path, resolution=None):
+        """Return False when Inkscape must be used instead"""
+        for feature in self.UNSUPPORTED_FEATURES:
+            if feature in export_data:
+                logging.debug("  Native engine: {} not supported".format(feature))
+                return False
+
+        scale, width, height = self.scale, self.width, self.height
+        if resolution != None:
+            scale = resolution.dpi / 96 if resolution.dpi != None else 1
+            width, height = resolution.width, resolution.height
+
+        try:
+            cairosvg.svg2png(
+                bytestring=export_data,
+                write_to=output_path,
+                scale=scale,
+                output_width=width,
+                output_height=height,
+            )
+        except Exception as error:
+            logging.debug("  Native engine error: {}".format(error))
+            return False
+        return True
+
+
+class ExportCache:
+    """Hashes of the exported documents, stored next to the exported files"""
+
+    FILE_NAME = ".batch_export_cache.json"
+
+    def __init__(self, options: Options):
+        self.index_path = os.path.join(options.output_path, self.FILE_NAME)
+        self.lock = threading.Lock()
+
+        # Only options changing the result of a same document
+        self.options_key = json.dumps(
+            [
+                options.export_type,
+                options.export_plain_svg,
+                options.export_pdf_version,
+                options.export_area_type,
+                options.export_area_size,
+                options.export_res_type,
+                options.export_res_dpi,
+                options.export_res_width,
+                options.export_res_height,
+                # Cropped files are replaced, they can't be uncropped
+                options.trim_png,
+                options.trim_padding if options.trim_png else None,
+            ]
+        ).encode("utf-8")
+
+        self.entries = {}
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            logging.debug("  No cache index found at {}".format(self.index_path))
+
+    # Sent to the worker processes without the lock
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def layer_hash(self, *documents_data):
+        layer_hash = hashlib.sha256(self.options_key)
+        for data in documents_data:
+            layer_hash.update(data)
+        return layer_hash.hexdigest()
+
+    def contains(self, path):
+        return path in self.entries
+
+    def is_up_to_date(self, path, layer_hash):
+        return self.entries.get(path) == layer_hash and os.path.exists(path)
+
+    def update(self, path, layer_hash):
+        # Only keep what have been really exported
+        with self.lock:
+            if os.path.exists(path):
+                self.entries[path] = layer_hash
+            else:
+                self.entries.pop(path, None)
+
+    def save(self):
+        logging.debug("  Save cache index to {}\n".format(self.index_path))
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        with open(self.index_path, "w+", encoding="utf-8") as f:
+            json.dump(self.entries, f, ensure_ascii=False, indent=4)
+
+
+class ExportScheduler:
+    """Estimate the export duration of the layers, to start the longest first"""
+
+    # Relative costs, scaled to seconds by the timings of a previous export
+    NODE_COST = 1.0
+    IMAGE_BYTE_COST = 0.001
+    FILTER_COST = 200.0
+
+    # Memory used by an export worker and its Inkscape, in bytes
+    WORKER_MEMORY = 300 * 1024 * 1024
+
+    def __init__(self, options: Options):
+        self.timings_path = os.path.join(options.output_path, "timings.json")
+
+    def estimate(self, layer):
+        nodes = filters = image_bytes = 0
+        for element in layer.iter():
+            # Skip comments and processing instructions
+            if not isinstance(element.tag, str):
+                continue
+            nodes += 1
+
+            # Embedded images have to be decoded
+            href = element.attrib.get(inkex.addNS("href", "xlink")) or ""
+            if href.startswith("data:"):
+                image_bytes += len(href)
+
+            # Filters are rendered per pixel
+            if "filter" in element.attrib or "filter:url" in element.attrib.get(
+                "style", ""
+            ):
+                filters += 1
+
+        return (
+            nodes * self.NODE_COST
+            + image_bytes * self.IMAGE_BYTE_COST
+            + filters * self.FILTER_COST
+        )
+
+    def load_previous_durations(self):
+        try:
+            with open(self.timings_path, "r", encoding="utf-8") as f:
+                layers_timings = json.load(f)["layers"]
+        except (OSError, ValueError, KeyError):
+            logging.debug("  No previous timings at {}".format(self.timings_path))
+            return {}
+
+        durations = {}
+        for path, timings in layers_timings.items():
+            if timings.get("cached"):
+                continue
+            durations[path] = sum(
+                timings.get(step, 0)
+                for step in ("prepare", "serialize", "subprocess", "render")
+            )
+        return durations
+
+    def estimates(self, layers_export):
+        """Estimate of each layer, and if they are in seconds"""
+        estimates = {
+            path: self.estimate(layer) for path, (layer, _, _) in layers_export.items()
+        }
+
+        # Measured durations replace the estimates, and scale the others
+        durations = self.load_previous_durations()
+        measured = [path for path in estimates if path in durations]
+        total_estimate = sum(estimates[path] for path in measured)
+        if not measured or total_estimate <= 0:
+            return estimates, False
+
+        scale = sum(durations[path] for path in measured) / total_estimate
+        for path in estimates:
+            estimates[path] = durations.get(path, estimates[path] * scale)
+        return estimates, True
+
+    def schedule(self, layers_export):
+        """Layers ordered from the longest to export, with their estimate"""
+        estimates, _ = self.estimates(layers_export)
+        order = sorted(estimates, key=lambda path: estimates[path], reverse=True)
+        return {path: layers_export[path] for path in order}, estimates
+
+    def workers_count(self, nb_layers):
+        count = os.cpu_count() or 1
+        memory = self.available_memory()
+        if memory != None:
+            count = min(count, memory // self.WORKER_MEMORY)
+        return max(1, min(count, nb_layers))
+
+    @staticmethod
+    def available_memory():
+        """Available physical memory in bytes, None if unknown"""
+        if sys.platform == "win32":
+            import ctypes
+
+            class MemoryStatus(ctypes.Structure):
+                _fields_ = [
+                    ("dwLength", ctypes.c_ulong),
+                    ("dwMemoryLoad", ctypes.c_ulong),
+                    ("ullTotalPhys", ctypes.c_ulonglong),
+                    ("ullAvailPhys", ctypes.c_ulonglong),
+                    ("ullTotalPageFile", ctypes.c_ulonglong),
+                    ("ullAvailPageFile", ctypes.c_ulonglong),
+                    ("ullTotalVirtual", ctypes.c_ulonglong),
+                    ("ullAvailVirtual", ctypes.c_ulonglong),
+                    ("ullAvailExtendedVirtual", ctypes.c_ulonglong),
+                ]
+
+            status = MemoryStatus()
+            status.dwLength = ctypes.sizeof(MemoryStatus)
+            if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+                return status.ullAvailPhys
+            return None
+
+        try:
+            return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        except (AttributeError, ValueError, OSError):
+            # Not available on macOS
+            return None
+
+
+class ExportProgress:
+    """Log each exported layer and keep a partial manifest of the done ones"""
+
+    # Seconds between two writes of the partial manifest
+    MANIFEST_INTERVAL = 1.0
+
+    def __init__(self, layers_export, layers_todo, write_manifest=None, nb_files=1):
+        self.layers_export = layers_export
+        self.done_paths = set(layers_export) - set(layers_todo)
+        # Files of each layer, one by resolution
+        self.total = len(layers_todo) * nb_files
+        self.done = 0
+        self.start = time.perf_counter()
+        self.write_manifest = write_manifest
+        self.manifest_time = self.start
+
+    def update(self, result):
+        self.done += 1
+        self.done_paths.add(result["layer"])
+
+        elapsed = time.perf_counter() - self.start
+        remaining = elapsed / self.done * (self.total - self.done)
+        logging.debug(
+            "  [{}/{}] {}{} - ETA {:.1f}s".format(
+                self.done,
+                self.total,
+                result["path"],
+                " (cached)" if result["cached"] else "",
+                remaining,
+            )
+        )
+
+        # Rewritten at intervals, a whole manifest for each layer is quadratic
+        now = time.perf_counter()
+        if self.write_manifest != None and (
+            now - self.manifest_time >= self.MANIFEST_INTERVAL
+            or self.done == self.total
+        ):
+            self.manifest_time = now
+            self.write_manifest(
+                {
+                    path: layer_export
+                    for path, layer_export in self.layers_export.items()
+                    if path in self.done_paths
+                }
+            )
+
+
+class ExportJournal:
+    """Files of an export, listed before being written, to be resumed"""
+
+    FILE_NAME = ".batch_export_journal"
+
+    def __init__(self, output_path):
+        self.path = os.path.join(output_path, self.FILE_NAME)
+
+    def read(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return {line.rstrip("\n") for line in f if line.strip()}
+        except OSError:
+            return set()
+
+    def record(self, paths):
+        # Appended at once, from threads and processes
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("".join(path + "\n" for path in paths))
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class PngTrimmer:
+    """Crop the exported PNG layers to their visible pixels"""
+
+    # Offsets of a trimmed file, inside it to be found by the next exports
+    TEXT_KEY = "batch-export-trim"
+
+    def __init__(self, options: Options):
+        self.padding = options.trim_padding
+
+    @staticmethod
+    def is_available(options: Options):
+        if Image == None or numpy == None:
+            logging.debug("  Trim: PIL and NumPy can't be imported")
+            return False
+        if options.export_type != "png":
+            logging.debug("  Trim: only for PNG export")
+            return False
+        return True
+
+    @staticmethod
+    def read_rectangle(image):
+        """Rectangle stored by a previous trim, with the page size, or None"""
+        if PngTrimmer.TEXT_KEY not in image.info:
+            return None
+        return json.loads(image.info[PngTrimmer.TEXT_KEY])
+
+    def trim(self, path):
+        """Return the rectangle of the file inside the layer page"""
+        with Image.open(path) as image:
+            # Cached or resumed files have been trimmed by a previous export
+            rectangle = self.read_rectangle(image)
+            if rectangle != None:
+                return {key: rectangle[key] for key in ("x", "y", "width", "height")}
+            image.load()
+            dpi = image.info.get("dpi")
+
+        if "A" not in image.getbands():
+            if "transparency" not in image.info:
+                return {"x": 0, "y": 0, "width": image.width, "height": image.height}
+            image = image.convert("RGBA")
+
+        # Visible rows and columns, a fully transparent layer keeps one pixel
+        alpha = numpy.asarray(image.getchannel("A"))
+        rows = numpy.flatnonzero(alpha.any(axis=1))
+        columns = numpy.flatnonzero(alpha.any(axis=0))
+        left, top, right, bottom = 0, 0, 1, 1
+        if rows.size > 0:
+            left = max(int(columns[0]) - self.padding, 0)
+            top = max(int(rows[0]) - self.padding, 0)
+            right = min(int(columns[-1]) + 1 + self.padding, image.width)
+            bottom = min(int(rows[-1]) + 1 + self.padding, image.height)
+
+        rectangle = {"x": left, "y": top, "width": right - left, "height": bottom - top}
+        page = {"width": image.width, "height": image.height}
+        info = PngImagePlugin.PngInfo()
+        info.add_text(self.TEXT_KEY, json.dumps(dict(rectangle, page=page)))
+        image.crop((left, top, right, bottom)).save(path, pnginfo=info, dpi=dpi)
+        return rectangle
+
+
+class PngOptimizer:
+    """Recompress the exported PNG layers, without changing their pixels"""
+
+    # Zlib strategies tried, the smallest file is kept
+    STRATEGIES = (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED, zlib.Z_RLE)
+    # Never bigger than the lower levels, which are only faster
+    LEVEL = 9
+    # Filter of all the rows: none, sub, up, average, paeth. Pillow only
+    # writes an adaptive filter by row, and none for the palettes.
+    FILTERS = (0, 1, 2, 3, 4)
+    # Encodings compressed with each strategy, the smallest at a fast level
+    ENCODINGS_KEPT = 2
+    FAST_LEVEL = 1
+    # 8 bits modes written with the filters, by PNG color type
+    COLOR_TYPES = {"L": 0, "RGB": 2, "P": 3, "LA": 4, "RGBA": 6}
+    SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+    def __init__(self, options: Options):
+        self.reduce_palette = options.optimize_palette and numpy != None
+        if options.optimize_palette and numpy == None:
+            logging.debug("  Optimize: NumPy can't be imported, palette not reduced")
+        self.use_filters = numpy != None
+        if numpy == None:
+            logging.debug("  Optimize: NumPy can't be imported, filters not tried")
+
+    @staticmethod
+    def is_available(options: Options):
+        if Image == None:
+            logging.debug("  Optimize: PIL can't be imported")
+            return False
+        if options.export_type != "png":
+            logging.debug("  Optimize: only for PNG export")
+            return False
+        return True
+
+    def palette_image(self, image):
+        """Same pixels with a palette, None with more than 256 colors"""
+        rgba = numpy.ascontiguousarray(numpy.asarray(image.convert("RGBA")))
+        colors, indexes = numpy.unique(
+            rgba.view(numpy.uint32).reshape(-1), return_inverse=True
+        )
+        if colors.size > 256:
+            return None
+
+        # Exact colors, without the dithering of quantize()
+        palette = colors.view(numpy.uint8).reshape(-1, 4)
+        palette_image = Image.fromarray(
+            indexes.astype(numpy.uint8).reshape(rgba.shape[:2]), "P"
+        )
+        palette_image.putpalette(palette[:, :3].tobytes())
+        if (palette[:, 3] < 255).any():
+            palette_image.info["transparency"] = palette[:, 3].tobytes()
+        return palette_image
+
+    @staticmethod
+    def filtered_rows(image, filter_type):
+        """Rows of the image, each with its filter type byte first"""
+        pixels = numpy.asarray(image)
+        depth = pixels.shape[2] if pixels.ndim == 3 else 1
+        rows = pixels.reshape(pixels.shape[0], -1).astype(numpy.int16)
+
+        # Bytes of the previous pixel and row, 0 before the image
+        left = numpy.zeros_like(rows)
+        left[:, depth:] = rows[:, :-depth]
+        up = numpy.zeros_like(rows)
+        up[1:] = rows[:-1]
+        if filter_type == 0:
+            predictor = 0
+        elif filter_type == 1:
+            predictor = left
+        elif filter_type == 2:
+            predictor = up
+        elif filter_type == 3:
+            predictor = (left + up) // 2
+        else:
+            up_left = numpy.zeros_like(rows)
+            up_left[1:, depth:] = rows[:-1, :-depth]
+            estimate = left + up - up_left
+            left_distance = numpy.abs(estimate - left)
+            up_distance = numpy.abs(estimate - up)
+            up_left_distance = numpy.abs(estimate - up_left)
+            predictor = numpy.where(
+                (left_distance <= up_distance) & (left_distance <= up_left_distance),
+                left,
+                numpy.where(up_distance <= up_left_distance, up, up_left),
+            )
+
+        filtered = ((rows - predictor) & 0xFF).astype(numpy.uint8)
+        types = numpy.full((filtered.shape[0], 1), filter_type, numpy.uint8)
+        return numpy.hstack((types, filtered)).tobytes()
+
+    def png_data(self, image, rows, text, level, strategy):
+        """PNG file of the filtered rows, with the trim rectangle text"""
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 15, 9, strategy)
+        chunks = [
+            (
+                b"IHDR",
+                struct.pack(
+                    ">IIBBBBB",
+                    image.width,
+                    image.height,
+                    8,
+                    self.COLOR_TYPES[image.mode],
+                    0,
+                    0,
+                    0,
+                ),
+            )
+        ]
+        if image.mode == "P":
+            chunks.append((b"PLTE", bytes(image.getpalette("RGB"))))
+            transparency = image.info.get("transparency")
+            if isinstance(transparency, int):
+                transparency = bytes([255] * transparency + [0])
+            if transparency != None:
+                chunks.append((b"tRNS", transparency))
+        if text != None:
+            chunks.append(
+                (b"tEXt", PngTrimmer.TEXT_KEY.encode() + b"\0" + text.encode("latin-1"))
+            )
+        chunks.append((b"IDAT", compressor.compress(rows) + compressor.flush()))
+        chunks.append((b"IEND", b""))
+
+        data = self.SIGNATURE
+        for chunk_type, chunk_data in chunks:
+            data += struct.pack(">I", len(chunk_data)) + chunk_type + chunk_data
+            data += struct.pack(">I", zlib.crc32(chunk_type + chunk_data))
+        return data
+
+    def encodings(self, candidate, text):
+        """Functions of the zlib level and strategy, giving the PNG data"""
+        info = PngImagePlugin.PngInfo()
+        if text != None:
+            info.add_text(PngTrimmer.TEXT_KEY, text)
+        parameters = {}
+        if "transparency" in candidate.info:
+            parameters["transparency"] = candidate.info["transparency"]
+
+        def pillow_encoding(level, strategy):
+            output = io.BytesIO()
+            candidate.save(
+                output,
+                "PNG",
+                compress_level=level,
+                compress_type=strategy,
+                pnginfo=info,
+                **parameters,
+            )
+            return output.getvalue()
+
+        encodings = [pillow_encoding]
+        # A color key of the other modes is only written by Pillow
+        if (
+            not self.use_filters
+            or candidate.mode not in self.COLOR_TYPES
+            or (candidate.mode != "P" and "transparency" in candidate.info)
+        ):
+            return encodings
+
+        for filter_type in self.FILTERS:
+            rows = self.filtered_rows(candidate, filter_type)
+            encodings.append(
+                lambda level, strategy, rows=rows: self.png_data(
+                    candidate, rows, text, level, strategy
+                )
+            )
+        return encodings
+
+    def optimize(self, path):
+        """Return the bytes saved, the file is only replaced when smaller"""
+        size = os.path.getsize(path)
+        with Image.open(path) as image:
+            image.load()
+
+        # Metadata is stripped, except the trim rectangle
+        text = image.info.get(PngTrimmer.TEXT_KEY)
+
+        candidates = [image]
+        if self.reduce_palette and image.mode != "P":
+            palette_image = self.palette_image(image)
+            if palette_image != None:
+                candidates.append(palette_image)
+
+        encodings = []
+        for candidate in candidates:
+            encodings += self.encodings(candidate, text)
+        # The filters compress alike with each strategy, only the best are tried
+        if len(encodings) > self.ENCODINGS_KEPT:
+            encodings.sort(
+                key=lambda encoding: len(
+                    encoding(self.FAST_LEVEL, zlib.Z_DEFAULT_STRATEGY)
+                )
+            )
+            encodings = encodings[: self.ENCODINGS_KEPT]
+
+        best_data = None
+        for encoding in encodings:
+            for strategy in self.STRATEGIES:
+                data = encoding(self.LEVEL, strategy)
+                if best_data == None or len(data) < len(best_data):
+                    best_data = data
+
+        if len(best_data) >= size:
+            return 0
+
+        # Replaced at once, the file stays valid if the export is stopped
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as f:
+            f.write(best_data)
+        os.replace(temporary_path, path)
+        return size - len(best_data)
+
+
+class PngPostProcessor:
+    """Trim and optimize the PNG files on their own pool, as they are exported"""
+
+    def __init__(self, options: Options, trimmer=None, optimizer=None, executor=None):
+        self.trimmer = trimmer
+        self.optimizer = optimizer
+        # Not the export pool, the render workers don't wait for it. A shared
+        # pool (see batch_export_cli.py) is used as is, it is not shut down.
+        self.shared = executor != None
+        if executor == None:
+            executor = ThreadPoolExecutor(max_workers=options.number_threads)
+        self.executor = executor
+        self.futures = {}
+
+    def update(self, result):
+        """Process the file of an export result"""
+        if result["error"] == None:
+            self.submit(result["path"], not result["cached"])
+
+    def submit(self, path, exported=True):
+        if path not in self.futures:
+            self.futures[path] = self.executor.submit(self.process, path, exported)
+
+    def process(self, path, exported):
+        """Return the trim rectangle and the bytes saved, None if not done"""
+        rectangle = saved = None
+        if not os.path.exists(path):
+            return rectangle, saved
+        try:
+            if self.trimmer != None:
+                rectangle = self.trimmer.trim(path)
+            # Files not exported by this run have already been optimized
+            if self.optimizer != None and exported:
+                saved = self.optimizer.optimize(path)
+        except Exception as error:
+            logging.debug("  Post process: {} failed, {}".format(path, error))
+        return rectangle, saved
+
+    def finish(self, paths):
+        """Return the trim rectangles and the bytes saved, by path
+
+        The files not given by the export results are processed too."""
+        for path in paths:
+            self.submit(path, exported=False)
+
+        files_trim, files_saved = {}, {}
+        try:
+            # NumPy, PIL and zlib release the GIL, files are processed in parallel
+            for path, future in self.futures.items():
+                rectangle, saved = future.result()
+                if rectangle != None:
+                    logging.debug(
+                        "  {} ({}x{} at {},{})".format(
+                            path,
+                            rectangle["width"],
+                            rectangle["height"],
+                            rectangle["x"],
+                            rectangle["y"],
+                        )
+                    )
+                    files_trim[path] = rectangle
+                if saved != None:
+                    logging.debug("  {}: {} bytes saved".format(path, saved))
+                    files_saved[path] = saved
+        finally:
+            if not self.shared:
+                self.executor.shutdown()
+
+        if self.optimizer != None:
+            logging.debug(
+                "  TOTAL BYTES SAVED: {} ({} files)\n".format(
+                    sum(files_saved.values()), len(files_saved)
+                )
+            )
+        return files_trim, files_saved
+
+    def cancel(self):
+        """Drop the files not processed yet, when the export is stopped"""
+        for future in self.futures.values():
+            future.cancel()
+        if not self.shared:
+            self.executor.shutdown(cancel_futures=True)
+
+
+class AtlasPacker:
+    """Pack the exported PNG layers in atlas pages, row by row"""
+
+    FILE_NAME = "atlas_{}.png"
+    PAGE_NAME = re.compile(r"atlas_(0|[1-9][0-9]*)\.png")
+
+    def __init__(self, options: Options):
+        self.output_path = options.output_path
+        self.max_size = options.atlas_size
+        self.padding = options.atlas_padding
+        self.trim = options.atlas_trim
+
+    @staticmethod
+    def is_available(options: Options):
+        if Image == None:
+            logging.debug("  Atlas: PIL can't be imported")
+            return False
+        if options.export_type != "png":
+            logging.debug("  Atlas: only for PNG export")
+            return False
+        return True
+
+    @classmethod
+    def is_page_path(cls, output_path, path):
+        folder, name = os.path.split(os.path.normpath(path))
+        return os.path.normcase(folder) == os.path.normcase(
+            os.path.normpath(output_path)
+        ) and (cls.PAGE_NAME.fullmatch(name) != None)
+
+    @classmethod
+    def existing_pages(cls, output_path):
+        """Pages found in the export folder, by index"""
+        try:
+            names = os.listdir(output_path)
+        except OSError:
+            return {}
+        pages = {}
+        for name in names:
+            match = cls.PAGE_NAME.fullmatch(name)
+            if match != None:
+                pages[int(match.group(1))] = os.path.join(output_path, name)
+        return pages
+
+    def load_sprite(self, path):
+        with Image.open(path) as source:
+            rectangle = PngTrimmer.read_rectangle(source)
+            image = source.convert("RGBA")
+        width, height = image.size
+
+        # Already cropped by trim-png, the offset and size are in the page
+        x, y = 0, 0
+        if rectangle != None and "page" in rectangle:
+            x, y = rectangle["x"], rectangle["y"]
+            width, height = rectangle["page"]["width"], rectangle["page"]["height"]
+
+        # Transparent borders are not packed
+        bounds = (0, 0, image.width, image.height)
+        if self.trim:
+            bounds = image.getchannel("A").getbbox() or (0, 0, 1, 1)
+            image = image.crop(bounds)
+
+        return {
+            "path": path,
+            "image": image,
+            "trim": {"x": x + bounds[0], "y": y + bounds[1]},
+            "size": {"width": width, "height": height},
+        }
+
+    def place(self, sprites):
+        """Shelf packing, the tallest sprites first"""
+        pages = []
+        page = shelf = None
+        for sprite in sorted(
+            sprites,
+            key=lambda sprite: (-sprite["image"].height, -sprite["image"].width),
+        ):
+            width = sprite["image"].width + self.padding
+            height = sprite["image"].height + self.padding
+
+            # Bigger than a page, alone on its own
+            if width > self.max_size or height > self.max_size:
+                logging.debug("  Atlas: {} bigger than a page".format(sprite["path"]))
+                sprite["x"], sprite["y"] = 0, 0
+                pages.append(
+                    {
+                        "sprites": [sprite],
+                        "width": sprite["image"].width,
+                        "height": sprite["image"].height,
+                    }
+                )
+                continue
+
+            # New shelf when the current one is full
+            if shelf == None or shelf["x"] + width > self.max_size:
+                y = shelf["y"] + shelf["height"] if shelf != None else 0
+                if page == None or y + height > self.max_size:
+                    page = {"sprites": [], "width": 0, "height": 0}
+                    pages.append(page)
+                    y = 0
+                shelf = {"x": 0, "y": y, "height": height}
+
+            sprite["x"], sprite["y"] = shelf["x"], shelf["y"]
+            shelf["x"] += width
+            page["sprites"].append(sprite)
+            page["width"] = max(page["width"], shelf["x"] - self.padding)
+            page["height"] = max(page["height"], shelf["y"] + height - self.padding)
+        return pages
+
+    def export(self, paths):
+        """Return the atlas informations of each layer, by path"""
+        sprites = []
+        for path in paths:
+            if not os.path.exists(path):
+                logging.debug("  Atlas: {} not exported".format(path))
+                continue
+            sprites.append(self.load_sprite(path))
+
+        layers_atlas = {}
+        pages = self.place(sprites)
+        for index, page in enumerate(pages):
+            atlas_path = os.path.join(self.output_path, self.FILE_NAME.format(index))
+            atlas = Image.new("RGBA", (page["width"], page["height"]))
+            for sprite in page["sprites"]:
+                atlas.paste(sprite["image"], (sprite["x"], sprite["y"]))
+                layers_atlas[sprite["path"]] = {
+                    "atlas": {
+                        "path": atlas_path,
+                        "x": sprite["x"],
+                        "y": sprite["y"],
+                        "width": sprite["image"].width,
+                        "height": sprite["image"].height,
+                    },
+                    "trim": sprite["trim"],
+                    "size": sprite["size"],
+                }
+
+            logging.debug(
+                "  Atlas {} ({}x{}): {} layers".format(
+                    atlas_path, page["width"], page["height"], len(page["sprites"])
+                )
+            )
+            atlas.save(atlas_path)
+
+        # Pages of a previous bigger atlas, checked with the layers paths
+        for index, page_path in self.existing_pages(self.output_path).items():
+            if index >= len(pages):
+                logging.debug("  Atlas: remove previous {}".format(page_path))
+                os.remove(page_path)
+        return layers_atlas
+
+
+class CommandSupervisor:
+    """Run the Inkscape commands, killed when hung and retried when failed"""
+
+    def __init__(self, options: Options):
+        self.use_logging = options.use_logging
+        self.timeout = options.export_timeout
+        self.retries = options.export_retries
+        self.backoff = options.retry_backoff
+
+    def run(self, command, output_paths=(), timeout=None, input_data=None):
+        """Return the error of the last try, None on success"""
+        # A file of a previous export would be taken for the new one
+        for path in output_paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                delay = self.backoff * 2 ** (attempt - 1)
+                logging.debug(
+                    "  Retry {}/{} in {}s: {}".format(
+                        attempt, self.retries, delay, command
+                    )
+                )
+                time.sleep(delay)
+
+            error = self.run_once(command, timeout or self.timeout, input_data)
+            if error == None:
+                # Inkscape can exit normally without writing the file
+                missing = [
+                    path
+                    for path in output_paths
+                    if not os.path.exists(path) or os.path.getsize(path) == 0
+                ]
+                if missing:
+                    error = "missing or empty output {}".format(", ".join(missing))
+            if error == None:
+                return None
+            logging.debug("  Export failed: {} ({})".format(command, error))
+        return error
+
+    def run_once(self, command, timeout, input_data=None):
+        try:
+            # If not piped, stdout and stderr will be showed in an inkscape dialog at the end.
+            # Inkscape export will create A LOT of warnings, most of them repeated, and I believe
+            # it is pointless to crowd the log file with these warnings.
+            output = None if self.use_logging else subprocess.DEVNULL
+            stdin = subprocess.PIPE if input_data != None else None
+            with subprocess.Popen(
+                command, stdin=stdin, stdout=output, stderr=output
+            ) as proc:
+                try:
+                    proc.communicate(input_data, timeout=timeout)
+                except subprocess.TimeoutExpired:
+                    # Don't leave it running in background
+                    proc.kill()
+                    proc.wait()
+                    return "timeout after {}s".format(timeout)
+        except OSError as error:
+            return "OS error {}".format(error)
+
+        if proc.returncode != 0:
+            return "exit code {}".format(proc.returncode)
+        return None
+
+
+class InkscapeShellWorker:
+    """Long-lived "inkscape --shell" process receiving export actions on stdin"""
+
+    PROMPT = b"> "
+    # Inkscape answers with the prompt even when the actions have failed
+    ERROR = re.compile(r"error|could not|did not find|unable to|failed", re.IGNORECASE)
+
+    def __init__(self, use_logging, timeout=300):
+        self.use_logging = use_logging
+        self.timeout = timeout
+        self.process = None
+        self.output = None
+
+    def start(self):
+        self.process = subprocess.Popen(
+            ["inkscape", "--shell"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            # Errors of the actions are read with the answer
+            stderr=subprocess.STDOUT,
+        )
+        # Read in a thread, a blocking read on the pipe can't be timed out
+        self.output = queue.Queue()
+        threading.Thread(
+            target=self._read_output, args=(self.process, self.output), daemon=True
+        ).start()
+        self._wait_prompt()
+
+    def stop(self):
+        if self.process == None:
+            return
+        try:
+            self.process.stdin.write(b"quit\n")
+            self.process.stdin.flush()
+            self.process.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+        self._close()
+
+    def restart(self):
+        logging.debug("  Restart inkscape shell worker")
+        if self.process != None:
+            self.process.kill()
+            self._close()
+        self.start()
+
+    def _close(self):
+        self.process.wait()
+        for pipe in (self.process.stdin, self.process.stdout):
+            try:
+                pipe.close()
+            except OSError:
+                pass
+        self.process = None
+
+    def run(self, actions):
+        """Run the actions and wait the prompt, return the error if any"""
+        try:
+            if self.process == None or self.process.poll() != None:
+                self.restart()
+            self.process.stdin.write((";".join(actions) + "\n").encode("utf-8"))
+            self.process.stdin.flush()
+            output = self._wait_prompt()
+        except (OSError, EOFError, TimeoutError) as error:
+            logging.error("  Inkscape shell worker failed: {}".format(error))
+            try:
+                self.restart()
+            except (OSError, EOFError, TimeoutError):
+                self.process = None
+            return "shell worker failed: {}".format(error)
+
+        for line in output.splitlines():
+            if self.ERROR.search(line) and "warning" not in line.lower():
+                return line.strip()
+        return None
+
+    def _wait_prompt(self):
+        buffer = b""
+        remaining = self.timeout
+        while not buffer.endswith(self.PROMPT):
+            start = time.monotonic()
+            try:
+                data = self.output.get(timeout=remaining)
+            except queue.Empty:
+                raise TimeoutError("no answer after {}s".format(self.timeout))
+            if data == None:
+                raise EOFError("inkscape shell exited")
+            buffer += data
+            remaining -= time.monotonic() - start
+        output = buffer.decode("utf-8", "replace")
+        if self.use_logging and buffer.strip(self.PROMPT):
+            logging.debug(output)
+        return output
+
+    @staticmethod
+    def _read_output(process, output):
+        while True:
+            try:
+                data = os.read(process.stdout.fileno(), 4096)
+            except OSError:
+                data = b""
+            if not data:
+                output.put(None)
+                return
+            output.put(data)
+
+
+class InkscapeShellPool:
+    """One shell worker per thread, started when first needed"""
+
+    def __init__(self, size, use_logging, timeout=300):
+        self.workers = [InkscapeShellWorker(use_logging, timeout) for _ in range(size)]
+        # The last used first, only the shells needed at once are started
+        self.idle = queue.LifoQueue()
+        for worker in self.workers:
+            self.idle.put(worker)
+
+    def export(self, command, svg_path, output_path):
+        """Return the error if the file has not been written"""
+        actions = (
+            ["file-open:{}".format(svg_path)]
+            + command_to_actions(command)
+            + ["export-filename:{}".format(output_path), "export-do", "file-close"]
+        )
+
+        # A file of a previous export would be taken for the new one
+        if os.path.exists(output_path):
+            os.remove(output_path)
+
+        worker = self.idle.get()
+        try:
+            error = worker.run(actions)
+        finally:
+            self.idle.put(worker)
+
+        if error == None and (
+            not os.path.exists(output_path) or os.path.getsize(output_path) == 0
+        ):
+            error = "missing or empty output {}".format(output_path)
+        return error
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+
+
 class BatchExporter(inkex.EffectExtension):
-    def __init__(self):
+    def __init__(self, executor=None):
         """init the effetc library and get options from gui"""
         inkex.Effect.__init__(self)
 
+        # Thread pool shared between exporters, see batch_export_cli.py
+        self.executor = executor
+        # Errors of the layers not exported, by path
+        self.layers_error = {}
+        # Files of the layers by resolution, with a resolutions list
+        self.layers_files = {}
+        # Variant frames, by hierarchy and by path
+        self.variant_frames = {}
+        self.layers_frames = {}
+        # Paths conflicts reported by a dry run, by file path
+        self.files_conflicts = {}
+
         # Export file page
         self.arg_parser.add_argument(
             "--export-type",
@@ -201,6 +2017,14 @@ class BatchExporter(inkex.EffectExtension):
             default=False,
             help="",
         )
+        self.arg_parser.add_argument(
+            "--case-insensitive-paths",
+            action="store",
+            type=str,
+            dest="case_insensitive_paths",
+            default=False,
+            help="",
+        )
         self.arg_parser.add_argument(
             "--export-manifest",
             action="store",
@@ -209,6 +2033,102 @@ class BatchExporter(inkex.EffectExtension):
             default=True,
             help="",
         )
+        self.arg_parser.add_argument(
+            "--compact-manifest",
+            action="store",
+            type=str,
+            dest="compact_manifest",
+            default=False,
+            help="",
+        )
+        self.arg_parser.add_argument(
+            "--use-cache",
+            action="store",
+            type=str,
+            dest="use_cache",
+            default=False,
+            help="",
+        )
+        self.arg_parser.add_argument(
+            "--resume",
+            action="store",
+            type=str,
+            dest="resume",
+            default=False,
+            help="",
+        )
+        self.arg_parser.add_argument(
+            "--dry-run",
+            action="store",
+            type=str,
+            dest="dry_run",
+            default=False,
+            help="",
+        )
+        self.arg_parser.add_argument(
+            "--trim-png",
+            action="store",
+            type=str,
+            dest="trim_png",
+            default=False,
+            help="",
+        )
+        self.arg_parser.add_argument(
+            "--trim-padding",
+            action="store",
+            type=int,
+            dest="trim_padding",
+            default="0",
+            help="",
+        )
+        self.arg_parser.add_argument(
+            "--optimize-png",
+            action="store",
+            type=str,
+            dest="optimize_png",
+            default=False,
+            help="",
+        )
+        self.arg_parser.add_argument(
+            "--optimize-palette",
+            action="store",
+            type=str,
+            dest="optimize_palette",
+            default=False,
+            help="",
+        )
+        self.arg_parser.add_argument(
+            "--export-atlas",
+            action="store",
+            type=str,
+            dest="export_atlas",
+            default=False,
+            help="",
+        )
+        self.arg_parser.add_argument(
+            "--atlas-size",
+            action="store",
+            type=int,
+            dest="atlas_size",
+            default="2048",
+            help="",
+        )
+        self.arg_parser.add_argument(
+            "--atlas-padding",
+            action="store",
+            type=int,
+            dest="atlas_padding",
+            default="2",
+            help="",
+        )
+        self.arg_parser.add_argument(
+            "--atlas-trim",
+            action="store",
+            type=str,
+            dest="atlas_trim",
+            default=True,
+            help="",
+        )
 
         # Controls page
         self.arg_parser.add_argument(
@@ -267,6 +2187,22 @@ class BatchExporter(inkex.EffectExtension):
             default=True,
             help="",
         )
+        self.arg_parser.add_argument(
+            "--variant-prefix",
+            action="store",
+            type=str,
+            dest="variant_prefix",
+            default="[variant]",
+            help="",
+        )
+        self.arg_parser.add_argument(
+            "--variant-frames",
+            action="store",
+            type=str,
+            dest="variant_frames",
+            default="",
+            help="",
+        )
 
         # Export size page
         self.arg_parser.add_argument(
@@ -317,6 +2253,14 @@ class BatchExporter(inkex.EffectExtension):
             default="100",
             help="",
         )
+        self.arg_parser.add_argument(
+            "--export-res-list",
+            action="store",
+            type=str,
+            dest="export_res_list",
+            default="1x=96;2x=192",
+            help="",
+        )
 
         # File naming page
         self.arg_parser.add_argument(
@@ -385,6 +2329,62 @@ class BatchExporter(inkex.EffectExtension):
             default="1",
             help="",
         )
+        self.arg_parser.add_argument(
+            "--scheduling",
+            action="store",
+            type=str,
+            dest="scheduling",
+            default="static",
+            help="",
+        )
+        self.arg_parser.add_argument(
+            "--export-engine",
+            action="store",
+            type=str,
+            dest="export_engine",
+            default="process",
+            help="",
+        )
+        self.arg_parser.add_argument(
+            "--pool-type",
+            action="store",
+            type=str,
+            dest="pool_type",
+            default="thread",
+            help="",
+        )
+        self.arg_parser.add_argument(
+            "--export-transport",
+            action="store",
+            type=str,
+            dest="export_transport",
+            default="file",
+            help="",
+        )
+        self.arg_parser.add_argument(
+            "--export-timeout",
+            action="store",
+            type=int,
+            dest="export_timeout",
+            default="300",
+            help="",
+        )
+        self.arg_parser.add_argument(
+            "--export-retries",
+            action="store",
+            type=int,
+            dest="export_retries",
+            default="2",
+            help="",
+        )
+        self.arg_parser.add_argument(
+            "--retry-backoff",
+            action="store",
+            type=float,
+            dest="retry_backoff",
+            default="1.0",
+            help="",
+        )
 
         # Help page
         self.arg_parser.add_argument(
@@ -406,6 +2406,14 @@ class BatchExporter(inkex.EffectExtension):
         self.arg_parser.add_argument(
             "--log-path", action="store", type=str, dest="log_path", default="", help=""
         )
+        self.arg_parser.add_argument(
+            "--export-timings",
+            action="store",
+            type=str,
+            dest="export_timings",
+            default=False,
+            help="",
+        )
 
         # HACK - the script is called with a "--tab controls" option as an argument from the notebook param in the inx file.
         # This argument is not used in the script. It's purpose is to suppress an error when the script is called.
@@ -432,6 +2440,10 @@ class BatchExporter(inkex.EffectExtension):
         # Check user options
         options = Options(self)
         logging.debug(options)
+        self.check_options(options)
+
+        # Wall and CPU durations of each step, in seconds
+        self.phases_timings = {}
 
         # Is working on self.document is safe ? Security
         self.working_doc = copy.deepcopy(self.document)
@@ -439,105 +2451,657 @@ class BatchExporter(inkex.EffectExtension):
         # Build the partial inkscape export command
         command = self.build_partial_command(options)
 
+        # A single document can't change the resolution of each file
+        if options.export_engine == "actions" and options.resolutions:
+            logging.debug(
+                "  Actions engine: fallback to process engine for resolutions\n"
+            )
+            options.export_engine = "process"
+
+        # Vector files would keep the other layers, hidden
+        if options.export_engine == "actions" and options.export_type != "png":
+            logging.debug(
+                "  Actions engine: fallback to process engine for {}\n".format(
+                    options.export_type
+                )
+            )
+            options.export_engine = "process"
+
+        # The workers of a shared pool are threads
+        if self.executor != None and options.pool_type == "process":
+            logging.debug("  Shared pool: fallback to thread pool\n")
+            options.pool_type = "thread"
+
         # Replace or delete clones
-        self.handles_clones(options.using_clones)
+        with self.timed_phase("handles_clones"):
+            self.handles_clones(options.using_clones)
+
+        # Walk the layer tree once, for the steps below
+        with self.timed_phase("index_layers"):
+            self.layer_index = LayerIndex(self.working_doc)
 
         # Delete skip branches
-        self.delete_skipped_layers(options.skip_hidden_layers, options.skip_prefix)
+        with self.timed_phase("delete_skipped_layers"):
+            self.delete_skipped_layers(options.skip_hidden_layers, options.skip_prefix)
 
         # Get the layers selected
-        layers_infos = self.get_layers(options.select_behavior, options.ignore_prefix)
+        with self.timed_phase("get_layers"):
+            layers_infos = self.get_layers(
+                options.select_behavior, options.ignore_prefix
+            )
+            layers_infos += self.get_variant_frames(
+                options.variant_prefix, options.variant_frames
+            )
+
+        # Hashes of the previous exports
+        cache = ExportCache(options) if options.use_cache else None
+
+        # Files being exported, with the manifest they allow to resume
+        journal = None
+        if options.export_manifest:
+            journal = ExportJournal(options.output_path)
+
+        # Layers of an interrupted export, with their file
+        resumed_paths = set()
+        resumed_files = set()
+        if options.resume:
+            resumed_paths, resumed_files = self.get_resumed_paths(
+                options.output_path, journal
+            )
 
         # Construct and path (duplicate names, file exists)
-        layers_export = self.fill_and_check_paths(layers_infos, options)
+        with self.timed_phase("fill_and_check_paths"):
+            layers_export = self.fill_and_check_paths(
+                layers_infos, options, cache, resumed_files
+            )
+
+        # Only the layers missing from the previous export
+        layers_todo = {
+            path: layer_export
+            for path, layer_export in layers_export.items()
+            if not all(
+                file_path in resumed_paths
+                for _, file_path in self.layers_files.get(path, [(None, path)])
+            )
+        }
+        if resumed_paths:
+            logging.debug(
+                "  Resume: {} layers already exported\n".format(
+                    len(layers_export) - len(layers_todo)
+                )
+            )
 
-        doc = self.create_base_export_document()
+        # Longest layers first, workers for the machine
+        if options.scheduling == "auto":
+            with self.timed_phase("schedule"):
+                layers_todo = self.schedule_layers(layers_todo, options)
+
+        # Only tell what the export would do
+        if options.dry_run:
+            with self.timed_phase("export_plan"):
+                self.export_plan(layers_export, layers_todo, options, cache)
+            return
+
+        # Files of an interrupted export are only kept to be resumed
+        if journal != None and not options.resume:
+            journal.remove()
+
+        with self.timed_phase("create_base_export_document"):
+            # Before the base document, it is also concerned
+            if options.child_layers_visible:
+                self.show_child_layers()
+
+            doc = self.create_base_export_document()
+
+        # Trim and optimize the files while the next ones are exported
+        trimmer = optimizer = post_processor = None
+        if options.trim_png and PngTrimmer.is_available(options):
+            trimmer = PngTrimmer(options)
+        if options.optimize_png and PngOptimizer.is_available(options):
+            optimizer = PngOptimizer(options)
+        if trimmer != None or optimizer != None:
+            post_processor = PngPostProcessor(
+                options, trimmer, optimizer, self.executor
+            )
 
         logging.debug(
             "\n---------------------------------------\n===> EXPORT PARALLEL\n---------------------------------------\n"
         )
         files_result = []
-        with ThreadPoolExecutor(max_workers=options.number_threads) as executor:
-            files_result = list(
-                executor.map(
-                    self.construct_thread(
-                        doc, command, options.use_logging, options.child_layers_visible
-                    ),
-                    layers_export.items(),
-                    chunksize=options.chunks_size,
-                )
-            )
+        try:
+            with self.timed_phase("export"):
+                export_start = time.time()
+                if options.export_engine == "actions":
+                    export_arguments = (
+                        doc,
+                        command,
+                        layers_todo,
+                        CommandSupervisor(options),
+                        cache,
+                        options.export_transport,
+                        journal,
+                    )
+                    # Its Inkscape is one of the workers of a shared pool
+                    if self.executor != None:
+                        files_result = self.executor.submit(
+                            self.export_single_document, *export_arguments
+                        ).result()
+                    else:
+                        files_result = self.export_single_document(*export_arguments)
+                    if post_processor != None:
+                        for result in files_result:
+                            post_processor.update(result)
+                else:
+                    # Partial manifest of the layers done
+                    def write_manifest(layers):
+                        self.export_manifest(
+                            layers, options.output_path, options.compact_manifest
+                        )
+
+                    progress = ExportProgress(
+                        layers_export,
+                        layers_todo,
+                        write_manifest if options.export_manifest else None,
+                        len(options.resolutions) or 1,
+                    )
+                    files_result = self.export_parallel(
+                        doc,
+                        command,
+                        layers_todo,
+                        options,
+                        cache,
+                        progress,
+                        post_processor,
+                        journal,
+                    )
+                layers_error = {
+                    result["path"]: result["error"]
+                    for result in files_result
+                    if result["error"] != None
+                }
+        except BaseException:
+            if post_processor != None:
+                post_processor.cancel()
+            raise
+        finally:
+            if cache != None:
+                cache.save()
 
         # for result in files_result:
         #     logging.debug(result)
 
+        self.layers_error = layers_error
+        self.report_failures(layers_error)
+
+        layers_extras = {}
+        if post_processor != None:
+            logging.debug(
+                "\n---------------------------------------\n===> POST PROCESS\n---------------------------------------\n"
+            )
+            with self.timed_phase("post_process"):
+                files_trim, files_saved = post_processor.finish(
+                    [
+                        file_path
+                        for path in layers_export
+                        for _, file_path in self.layers_files.get(path, [(None, path)])
+                        if file_path not in layers_error
+                    ]
+                )
+
+            for path in layers_export:
+                files = self.layers_files.get(path, [(None, path)])
+                # Rectangle of the layer file, and of each resolution
+                if path in files_trim:
+                    layers_extras.setdefault(path, {}).update(files_trim[path])
+                for resolution, file_path in self.layers_files.get(path, []):
+                    if file_path in files_trim:
+                        layers_extras.setdefault(path, {}).setdefault(
+                            "resolutions_trim", {}
+                        )[resolution.name] = files_trim[file_path]
+                # Bytes saved on the files of the layer
+                saved = [
+                    files_saved[file_path]
+                    for _, file_path in files
+                    if file_path in files_saved
+                ]
+                if saved:
+                    layers_extras.setdefault(path, {})["bytes_saved"] = sum(saved)
+
+        if options.export_atlas and AtlasPacker.is_available(options):
+            logging.debug(
+                "\n---------------------------------------\n===> ATLAS\n---------------------------------------\n"
+            )
+            with self.timed_phase("export_atlas"):
+                layers_atlas = AtlasPacker(options).export(
+                    path for path in layers_export if path not in layers_error
+                )
+            for path, atlas in layers_atlas.items():
+                layers_extras.setdefault(path, {}).update(atlas)
+
+        # Failed layers are kept in the manifest, with their error
+        files_layer = {result["path"]: result["layer"] for result in files_result}
+        for path, error in layers_error.items():
+            layers_extras.setdefault(files_layer.get(path, path), {})["error"] = error
+
+        # States of the variant frames
+        for path, frame in self.layers_frames.items():
+            layers_extras.setdefault(path, {})["variant"] = frame.states
+
+        # Files of every resolution
+        for path, files in self.layers_files.items():
+            layers_extras.setdefault(path, {})["resolutions"] = {
+                resolution.name: file_path for resolution, file_path in files
+            }
+
         if options.export_manifest:
             logging.debug(
                 "\n---------------------------------------\n===> JSON\n---------------------------------------\n"
             )
             # Json manifest
-            self.export_manifest(layers_export, options.output_path)
+            with self.timed_phase("export_manifest"):
+                self.export_manifest(
+                    layers_export,
+                    options.output_path,
+                    options.compact_manifest,
+                    layers_extras,
+                )
+            # The whole export is in the manifest
+            journal.remove()
+
+        self.export_timings(files_result, export_start, options)
+
+    def report_failures(self, layers_error):
+        if not layers_error:
+            return
+
+        summary = "\n---------------------------------------\n===> FAILURES\n---------------------------------------\n"
+        for path, error in layers_error.items():
+            summary += "  {}: {}\n".format(path, error)
+        logging.debug(summary)
+
+        # Not an user_error, the other layers have been exported
+        inkex.errormsg(
+            "Error exporting {} layers:\n{}".format(
+                len(layers_error), "\n".join(layers_error.keys())
+            )
+        )
+
+    def export_plan(self, layers_export, layers_todo, options: Options, cache=None):
+        scheduler = ExportScheduler(options)
+        estimates, in_seconds = scheduler.estimates(layers_export)
+        number_threads = options.number_threads
+        if options.scheduling == "auto" and self.executor == None:
+            number_threads = scheduler.workers_count(len(layers_todo))
+
+        layers_plan = []
+        statuses = {}
+        for path, (_, hierarchy, counter) in layers_export.items():
+            files_plan = []
+            for _, file_path in self.layers_files.get(path, [(None, path)]):
+                if file_path in self.files_conflicts:
+                    status = "conflict"
+                elif path not in layers_todo:
+                    status = "resume"
+                # Not hashed, the layer is only skipped if it is unchanged
+                elif (
+                    cache != None
+                    and cache.contains(file_path)
+                    and os.path.exists(file_path)
+                ):
+                    status = "in-cache"
+                elif os.path.exists(file_path):
+                    status = "overwrite"
+                else:
+                    status = "new"
+                statuses[status] = statuses.get(status, 0) + 1
+                files_plan.append({"path": file_path, "status": status})
+
+            layers_plan.append(
+                {
+                    "hierarchy": hierarchy,
+                    "order": counter,
+                    "files": files_plan,
+                    "cost": estimates[path],
+                }
+            )
+
+        # Layers in the cache are counted, they may have changed
+        total_cost = sum(estimates[path] for path in layers_todo)
+        plan = {
+            "layers": layers_plan,
+            "statuses": statuses,
+            # The export would stop on them, see the log for the details
+            "conflicts": [
+                dict(path=file_path, **conflict)
+                for file_path, conflict in self.files_conflicts.items()
+            ],
+            "cost_unit": "seconds" if in_seconds else "relative",
+            "total_cost": total_cost,
+            "number_threads": number_threads,
+            "expected_duration": total_cost / number_threads if in_seconds else None,
+        }
+
+        # Summary table
+        table = "\n---------------------------------------\n===> EXPORT PLAN\n---------------------------------------\n"
+        table += "  {:>12}  {:<10}{}\n".format("COST", "STATUS", "FILE")
+        for layer_plan in layers_plan:
+            for file_plan in layer_plan["files"]:
+                table += "  {:>12.3f}  {:<10}{}\n".format(
+                    layer_plan["cost"], file_plan["status"], file_plan["path"]
+                )
+        table += "\n  {} layers, {} files: {}\n".format(
+            len(layers_plan),
+            sum(statuses.values()),
+            ", ".join(
+                "{} {}".format(number, status) for status, number in statuses.items()
+            ),
+        )
+        if in_seconds:
+            table += "  Expected duration: {:.1f}s with {} workers\n".format(
+                plan["expected_duration"], number_threads
+            )
+        else:
+            table += (
+                "  Total cost: {:.1f} (no previous timings.json for seconds)\n".format(
+                    total_cost
+                )
+            )
+        if self.files_conflicts:
+            table += "  {} files in conflict, the export would stop:\n".format(
+                len(self.files_conflicts)
+            )
+            for file_path, conflict in self.files_conflicts.items():
+                table += "    {} ({})\n".format(file_path, conflict["reason"])
+        logging.debug(table)
+
+        plan_path = os.path.join(options.output_path, "plan.json")
+        logging.debug("  Export plan to {}\n".format(plan_path))
+        os.makedirs(options.output_path, exist_ok=True)
+        with open(plan_path, "w+", encoding="utf-8") as f:
+            json.dump(plan, f, ensure_ascii=False, indent=4)
+
+    def schedule_layers(self, layers_export, options: Options):
+        scheduler = ExportScheduler(options)
+        layers_export, estimates = scheduler.schedule(layers_export)
+
+        # Layers are given one by one, to balance the longest ones. A shared
+        # pool keeps its own number of workers, only the order is used.
+        if self.executor == None:
+            options.number_threads = scheduler.workers_count(len(layers_export))
+        options.chunks_size = 1
+        logging.debug(
+            "  Auto scheduling: {} workers for {} layers".format(
+                options.number_threads, len(layers_export)
+            )
+        )
+        for path in layers_export:
+            logging.debug("  {:>12.3f} {}".format(estimates[path], path))
+        return layers_export
+
+    def export_timings(self, files_result, export_start, options: Options):
+        # Nothing is written, don't stat every file. The CLI logs without
+        # use_logging, with --verbose.
+        if not options.export_timings and not logging.getLogger().isEnabledFor(
+            logging.DEBUG
+        ):
+            return
+
+        layers_timings = {}
+        for result in files_result:
+            layer_timings = dict(result["timings"])
+            layer_timings["queue_wait"] = result["start"] - export_start
+            layer_timings["cached"] = result["cached"]
+            layer_timings["bytes"] = (
+                os.path.getsize(result["path"]) if os.path.exists(result["path"]) else 0
+            )
+            layers_timings[result["path"]] = layer_timings
+
+        # Summary table
+        table = "\n---------------------------------------\n===> TIMINGS\n---------------------------------------\n"
+        table += "  {:<30}{:>12}{:>12}\n".format("PHASE", "WALL (s)", "CPU (s)")
+        for name, timings in self.phases_timings.items():
+            table += "  {:<30}{:>12.3f}{:>12.3f}\n".format(
+                name, timings["wall"], timings["cpu"]
+            )
+        columns = ("queue_wait", "prepare", "serialize", "subprocess")
+        table += "\n  {:>14}{:>14}{:>14}{:>14}{:>14}  {}\n".format(
+            "WAIT (s)", "PREPARE (s)", "SERIAL. (s)", "INKSCAPE (s)", "BYTES", "LAYER"
+        )
+        for path, timings in layers_timings.items():
+            table += "  {}{:>14}  {}\n".format(
+                "".join(
+                    "{:>14.3f}".format(timings.get(column, 0)) for column in columns
+                ),
+                timings["bytes"],
+                path,
+            )
+        logging.debug(table)
+
+        if options.export_timings:
+            timings_path = os.path.join(options.output_path, "timings.json")
+            logging.debug("  Export timings to {}\n".format(timings_path))
+            with open(timings_path, "w+", encoding="utf-8") as f:
+                json.dump(
+                    {"phases": self.phases_timings, "layers": layers_timings},
+                    f,
+                    ensure_ascii=False,
+                    indent=4,
+                )
+
+    @contextlib.contextmanager
+    def timed_phase(self, name):
+        start = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.phases_timings[name] = {
+                "wall": time.perf_counter() - start,
+                "cpu": time.process_time() - start_cpu,
+            }
+
+    def export_parallel(
+        self,
+        doc,
+        command,
+        layers_export,
+        options: Options,
+        cache=None,
+        progress=None,
+        post_processor=None,
+        journal=None,
+    ):
+        serializer = LayerDocumentSerializer(doc)
+        supervisor = CommandSupervisor(options)
+
+        rasterizer = None
+        if options.export_engine == "native":
+            if NativeRasterizer.is_available(options):
+                rasterizer = NativeRasterizer(options)
+            else:
+                logging.debug("  Fallback to process engine\n")
+
+        if options.pool_type == "process":
+            files_result = self.export_process_pool(
+                serializer,
+                command,
+                layers_export,
+                options,
+                supervisor,
+                cache,
+                rasterizer,
+                progress,
+                post_processor,
+                journal,
+            )
+        else:
+            shell_pool = None
+            if options.export_engine == "shell":
+                shell_pool = InkscapeShellPool(
+                    options.number_threads, options.use_logging, options.export_timeout
+                )
+
+            files_result = []
+            export_layer = self.construct_thread(
+                serializer,
+                command,
+                supervisor,
+                shell_pool,
+                cache,
+                rasterizer,
+                self.layer_index,
+                self.layers_files,
+                self.layers_frames,
+                options.export_transport,
+                journal,
+            )
+            if self.executor != None:
+                pool = contextlib.nullcontext(self.executor)
+            else:
+                pool = ThreadPoolExecutor(max_workers=options.number_threads)
+            try:
+                with pool as executor:
+                    futures = {
+                        executor.submit(export_layer, layer_export): [layer_export[0]]
+                        for layer_export in layers_export.items()
+                    }
+                    # Results as soon as they are done
+                    for future in as_completed(futures):
+                        for result in self.get_futures_results(future, futures):
+                            files_result.append(result)
+                            if progress != None:
+                                progress.update(result)
+                            if post_processor != None:
+                                post_processor.update(result)
+            finally:
+                if shell_pool != None:
+                    shell_pool.close()
+
+        if cache != None:
+            for result in files_result:
+                if not result["cached"] and result["error"] == None:
+                    cache.update(result["path"], result["hash"])
+        return files_result
+
+    def get_futures_results(self, future, futures):
+        """Results of a future of layers, failed results if it raised"""
+        try:
+            results = future.result()
+        except Exception as error:
+            logging.exception("  Export failed: {}".format(futures[future]))
+            return [
+                {
+                    "path": path,
+                    "layer": path,
+                    "hash": None,
+                    "cached": False,
+                    "error": "{}: {}".format(type(error).__name__, error),
+                    "start": time.time(),
+                    "timings": {},
+                }
+                for path in futures[future]
+            ]
+        return results if isinstance(results, list) else [results]
+
+    def export_process_pool(
+        self,
+        serializer,
+        command,
+        layers_export,
+        options: Options,
+        supervisor,
+        cache=None,
+        rasterizer=None,
+        progress=None,
+        post_processor=None,
+        journal=None,
+    ):
+        # Workers parse the document once, tasks only give the layer position
+        layers_position = {
+            info.element: index
+            for index, info in enumerate(self.layer_index.existing_layers())
+        }
+        tasks = [
+            (path, (layers_position[layer], hierarchy, counter))
+            for path, (layer, hierarchy, counter) in layers_export.items()
+        ]
+        # Sent by chunks, to limit the exchanges between processes
+        chunks = [
+            tasks[index : index + options.chunks_size]
+            for index in range(0, len(tasks), options.chunks_size)
+        ]
+
+        with ProcessPoolExecutor(
+            max_workers=options.number_threads,
+            initializer=_init_process_worker,
+            initargs=(
+                etree.tostring(self.working_doc),
+                serializer,
+                command,
+                supervisor,
+                options.log_file,
+                options.export_engine,
+                cache,
+                rasterizer,
+                self.layers_files,
+                # Frames layers by position too
+                {
+                    path: frame.with_layers(layers_position)
+                    for path, frame in self.layers_frames.items()
+                },
+                options.export_transport,
+                journal,
+            ),
+        ) as executor:
+            files_result = []
+            futures = {
+                executor.submit(_export_layers_process, chunk): [
+                    path for path, _ in chunk
+                ]
+                for chunk in chunks
+            }
+            for future in as_completed(futures):
+                for result in self.get_futures_results(future, futures):
+                    files_result.append(result)
+                    if progress != None:
+                        progress.update(result)
+                    if post_processor != None:
+                        post_processor.update(result)
+            return files_result
 
     def handles_clones(self, using_clones):
+        if using_clones:
+            ClonesResolver(self.working_doc).resolve()
+            return
+
         svg_clones = self.working_doc.xpath(
             "//svg:use[@xlink:href]", namespaces=inkex.NSS
         )
-
-        # Depth first
         for clone in reversed(svg_clones):
-            if using_clones:
-                copy = clone.unlink()
-                while is_clone(copy):
-                    copy = copy.unlink()
-
-                # Special case style
-                if float(clone.style.get("opacity", 1)) <= 0.0:
-                    copy.style["opacity"] = 0
-                    copy.style.update(copy.style)
-
-                # Change layer to group when unlinking
-                for child in copy.iter():
-                    if Layer.is_class_element(child):
-                        child.set("inkscape:groupmode", "")
-            else:
-                clone.delete()
+            clone.delete()
 
         # self._debug_svg_doc_wait(self.working_doc)
 
     def delete_skipped_layers(self, skip_hidden_layers, skip_prefix):
-        doc = self.working_doc
-
-        svg_layers = doc.xpath(
-            '//svg:g[@inkscape:groupmode="layer"]', namespaces=inkex.NSS
-        )
-
         nb_skipped = 0
-        for layer in svg_layers:
-            layer_label = get_name_element(layer)
-
+        for position, info in enumerate(self.layer_index.layers):
             # Delete skip_prefix or hidden layers
-            if layer_label.startswith(skip_prefix) or (
-                skip_hidden_layers
-                and "style" in layer.attrib
-                and "display:none" in layer.attrib["style"]
+            if info.label.startswith(skip_prefix) or (
+                skip_hidden_layers and info.hidden
             ):
-                logging.debug("  Skip: [{}]".format(layer_label))
-                layer.delete()
+                logging.debug("  Skip: [{}]".format(info.label))
+                self.layer_index.delete(position)
                 nb_skipped += 1
 
         logging.debug("  TOTAL NUMBER OF LAYERS SKIPPED: {}\n".format(nb_skipped))
         # self._debug_svg_doc_wait(doc)
 
     def get_layers(self, select_behavior, ignore_prefix):
-        doc = self.working_doc
-        svg_layers = doc.xpath(
-            '//svg:g[@inkscape:groupmode="layer"]', namespaces=inkex.NSS
-        )
-
+        layers = self.layer_index.layers
         layers_infos = []
 
-        for layer in svg_layers:
-            layer_label = get_name_element(layer)
+        for info in self.layer_index.existing_layers():
+            layer_label = info.label
             if layer_label == "":
                 continue
 
@@ -547,9 +3111,9 @@ class BatchExporter(inkex.EffectExtension):
 
             # Check if parent
             is_parent = any(
-                Layer.is_class_element(child)
-                and not get_name_element(child).startswith(ignore_prefix)
-                for child in layer.getchildren()
+                not layers[child].deleted
+                and not layers[child].label.startswith(ignore_prefix)
+                for child in info.children
             )
 
             if select_behavior == "only-leaf" and is_parent:
@@ -559,9 +3123,9 @@ class BatchExporter(inkex.EffectExtension):
                 continue
 
             # Get layer hierarchy (including self)
-            hierarchy = get_element_hierarchy(layer)
+            hierarchy = list(info.hierarchy)
 
-            layer_info = (layer, hierarchy)
+            layer_info = (info.element, hierarchy)
             layers_infos.append(layer_info)
 
         logging.debug("  TOTAL NUMBER OF LAYERS: {}\n".format(len(layers_infos)))
@@ -569,104 +3133,235 @@ class BatchExporter(inkex.EffectExtension):
         # self._debug_svg_doc_wait(doc)
         return layers_infos
 
-    def fill_and_check_paths(self, layer_infos, options: Options):
-        counter = options.number_start
-
-        layers_export = {}
+    def get_variant_frames(self, variant_prefix, variant_frames):
+        """Frames of the parents of variant layers, with their hierarchy"""
+        layers = self.layer_index.layers
+        frames_infos = []
+        self.variant_frames = {}
+        if variant_prefix == "":
+            return frames_infos
+
+        # Declared subset of the combinations, all of them if empty
+        frames_subset = {
+            frame_name.strip()
+            for frame_name in variant_frames.split(";")
+            if frame_name.strip() != ""
+        }
+        frames_found = set()
+
+        for info in self.layer_index.existing_layers():
+            if info.label == "" or info.label.startswith(variant_prefix):
+                continue
 
-        for layer, hierarchy in layer_infos:
-            path = self.get_path(hierarchy, counter, options)
+            variants = []
+            for child in info.children:
+                variant = layers[child]
+                if variant.deleted or not variant.label.startswith(variant_prefix):
+                    continue
+                states = [
+                    layers[state]
+                    for state in variant.children
+                    if not layers[state].deleted
+                ]
+                if states == []:
+                    logging.debug(
+                        "  Variant without states: [{}]".format(variant.label)
+                    )
+                    continue
+                variants.append((variant, states))
+
+            if variants == []:
+                continue
 
-            # Check if layer have same name or path (with ignored layers)
-            if not path in layers_export:
-                layers_export[path] = (layer, hierarchy, counter)
-            else:
-                layer_path = (">").join(hierarchy)
-                layer_path_existing = (">").join(layers_export[path][1])
-                user_error(
-                    "Same layer name",
-                    "Some layers have the same name, and the same path:\n"
-                    "{}\n{}\nPath ->{}\nPlease change names on layers.\n".format(
-                        layer_path, layer_path_existing, path
-                    ),
+            for frame_states in itertools.product(*[states for _, states in variants]):
+                frame_name = "+".join(state.label for state in frame_states)
+                if frames_subset and frame_name not in frames_subset:
+                    continue
+                frames_found.add(frame_name)
+
+                frame = VariantFrame(
+                    {
+                        variant.label.removeprefix(variant_prefix): state.label
+                        for (variant, _), state in zip(variants, frame_states)
+                    },
+                    [
+                        other.element
+                        for (_, states), state in zip(variants, frame_states)
+                        for other in states
+                        if other is not state
+                    ],
+                    [variant.element for variant, _ in variants]
+                    + [state.element for state in frame_states],
                 )
-                return {}
+                hierarchy = list(info.hierarchy) + [frame_name]
+                self.variant_frames[tuple(hierarchy)] = frame
+                frames_infos.append((info.element, hierarchy))
 
-            # Check if the file exists. If not, export it.
-            if not options.overwrite_files and os.path.exists(path):
-                user_error(
-                    "File already exists",
-                    f"File {path} already exist, check overwrite files if it's not an error.",
-                )
-                return {}
+        for frame_name in frames_subset - frames_found:
+            logging.debug("  Variant frame not found: [{}]".format(frame_name))
+        logging.debug(
+            "  TOTAL NUMBER OF VARIANT FRAMES: {}\n".format(len(frames_infos))
+        )
+        return frames_infos
+
+    @staticmethod
+    def check_options(options: Options):
+        """user_error on the options wrong whatever the document"""
+        # The name template and its filters are parsed at once
+        name_template = NameTemplate(options)
+        if len(options.resolutions) > 1 and "RES" not in name_template.tags:
+            user_error(
+                "Resolutions list",
+                "Resolutions would have the same file, add [RES] to the name template.",
+            )
 
-            counter += 1
+    def fill_and_check_paths(
+        self,
+        layer_infos,
+        options: Options,
+        cache=None,
+        resumed_files=(),
+    ):
+        counter = options.number_start
 
-        return layers_export
+        layers_export = {}
+        # A layer is exported by its first resolution path
+        self.layers_files = {}
+        self.layers_frames = {}
+        self.files_conflicts = {}
+        # Layers by normalized file path, to find all the conflicts at once
+        files_hierarchy = {}
+        existing_files = []
 
-    def get_path(self, hierarchy, counter, options: Options):
-        path = options.name_template
+        # Atlas pages are written after the layers, in the export folder
+        export_atlas = options.export_atlas and AtlasPacker.is_available(options)
+        atlas_files = []
 
-        # Ignore self for hierarchy keyword
-        layers_name = hierarchy[-1]
-        layers_hierarchy: list = hierarchy[:-1]
+        name_template = NameTemplate(options)
 
-        if not options.top_hierarchy_first:
-            layers_hierarchy = list(reversed(layers_hierarchy))
+        for layer, hierarchy in layer_infos:
+            files = [
+                (resolution, name_template.get_path(hierarchy, counter, resolution))
+                for resolution in options.resolutions or [None]
+            ]
+            path = files[0][1]
+            if options.resolutions:
+                self.layers_files[path] = files
+
+            for _, file_path in files:
+                # Check if layer have same name or path (with ignored layers)
+                file_key = os.path.normcase(os.path.normpath(file_path))
+                if options.case_insensitive_paths:
+                    file_key = file_key.casefold()
+                files_hierarchy.setdefault(file_key, []).append((file_path, hierarchy))
+                if export_atlas and AtlasPacker.is_page_path(
+                    options.output_path, file_path
+                ):
+                    atlas_files.append((file_path, hierarchy))
+
+                # Check if the file exists. If not, export it. Files from the cache
+                # or from the resumed export are ours.
+                if (
+                    not options.overwrite_files
+                    and os.path.exists(file_path)
+                    and not (cache != None and cache.contains(file_path))
+                    and file_path not in resumed_files
+                ):
+                    existing_files.append((file_path, hierarchy))
+
+            layers_export[path] = (layer, hierarchy, counter)
+            frame = self.variant_frames.get(tuple(hierarchy))
+            if frame != None:
+                self.layers_frames[path] = frame
+            counter += 1
 
-        # Extra separators conditions
-        add_left_sep = (layers_hierarchy != [] or options.empty_extra_separator) and (
-            options.separator_strategy == "left" or options.separator_strategy == "both"
-        )
-        add_right_sep = (layers_hierarchy != [] or options.empty_extra_separator) and (
-            options.separator_strategy == "right"
-            or options.separator_strategy == "both"
+        # Only the pages of a previous atlas export are replaced
+        atlas_pages = []
+        if export_atlas and not options.overwrite_files:
+            previous_pages = self.get_previous_atlas_paths(options.output_path)
+            atlas_pages = [
+                page_path
+                for page_path in AtlasPacker.existing_pages(
+                    options.output_path
+                ).values()
+                if os.path.normpath(page_path) not in previous_pages
+            ]
+
+        conflicts = self.paths_conflicts(
+            files_hierarchy, existing_files, atlas_files, atlas_pages
         )
-        # logging.debug(
-        #     "  Extra separators: [left={}, right={}]".format(
-        #         add_left_sep, add_right_sep
-        #     )
-        # )
-
-        # Add an extra element to add extra separators if empty (but not if both, redundant, or none)
-        if (
-            options.empty_extra_separator
-            and layers_hierarchy == []
-            and options.separator_strategy != "both"
-            and options.separator_strategy != "none"
-        ):
-            layers_hierarchy = [""]
-        if add_left_sep:
-            layers_hierarchy = [""] + layers_hierarchy
-        if add_right_sep:
-            layers_hierarchy = layers_hierarchy + [""]
+        if conflicts != "" and options.dry_run:
+            # Reported by the plan, with the files that would be exported
+            logging.debug("  Dry run, paths conflicts:\n{}".format(conflicts))
+            self.files_conflicts = self.get_files_conflicts(
+                files_hierarchy, existing_files, atlas_files, atlas_pages
+            )
+        elif conflicts != "":
+            user_error("Layers paths", conflicts)
+            return {}
 
-        # Replace
-        path = path.replace(
-            "[HIERARCHY]",
-            (options.hierarchy_separator).join(
-                [
-                    parent_name.removeprefix(options.ignore_prefix)
-                    for parent_name in layers_hierarchy
-                    if options.use_ignored_name
-                    or not parent_name.startswith(options.ignore_prefix)
-                ]
-            ),
-        )
+        return layers_export
 
-        path = path.replace("[LAYER_NAME]", layers_name)
-        path = path.replace("[NUM]", str(counter))
-        path = path.replace("[NUM-1]", str(counter).zfill(1))
-        path = path.replace("[NUM-2]", str(counter).zfill(2))
-        path = path.replace("[NUM-3]", str(counter).zfill(3))
-        path = path.replace("[NUM-4]", str(counter).zfill(4))
-        path = path.replace("[NUM-5]", str(counter).zfill(5))
-        path = "{}.{}".format(path, options.export_type)
-        # Special case user separator break local path
-        path = path.removeprefix("/").removeprefix("\\")
-        destination_path = os.path.join(options.output_path, path)
-        destination_path = os.path.normpath(destination_path)
-        return destination_path
+    def get_files_conflicts(
+        self, files_hierarchy, existing_files, atlas_files, atlas_pages
+    ):
+        """Reason and layers of each file in conflict, for the export plan"""
+        files_conflicts = {}
+        for layers in files_hierarchy.values():
+            if len(layers) > 1:
+                for file_path, _ in layers:
+                    files_conflicts[file_path] = {
+                        "reason": "same path",
+                        "layers": [list(hierarchy) for _, hierarchy in layers],
+                    }
+        for file_path, hierarchy in existing_files:
+            files_conflicts.setdefault(
+                file_path, {"reason": "exists", "layers": [list(hierarchy)]}
+            )
+        for file_path, hierarchy in atlas_files:
+            files_conflicts.setdefault(
+                file_path, {"reason": "atlas page", "layers": [list(hierarchy)]}
+            )
+        for page_path in atlas_pages:
+            files_conflicts[page_path] = {"reason": "atlas page exists", "layers": []}
+        return files_conflicts
+
+    def paths_conflicts(
+        self, files_hierarchy, existing_files, atlas_files=(), atlas_pages=()
+    ):
+        same_paths = [layers for layers in files_hierarchy.values() if len(layers) > 1]
+        message = ""
+        if same_paths != []:
+            message += "Some layers have the same name, and the same path:\n"
+            for layers in same_paths:
+                message += "Path ->{}\n".format(layers[0][0])
+                for _, hierarchy in layers:
+                    message += "  {}\n".format((">").join(hierarchy))
+            message += "Please change names on layers.\n"
+        if existing_files != []:
+            message += "Some files already exist:\n"
+            for file_path, hierarchy in existing_files:
+                message += "{} <- {}\n".format(file_path, (">").join(hierarchy))
+            message += "Check overwrite files if it's not an error.\n"
+        if atlas_files:
+            message += "Some layers have the path of an atlas page:\n"
+            for file_path, hierarchy in atlas_files:
+                message += "{} <- {}\n".format(file_path, (">").join(hierarchy))
+            message += "Please change names on layers.\n"
+        if atlas_pages:
+            message += "Some atlas pages already exist, not from a previous export:\n"
+            for page_path in atlas_pages:
+                message += "{}\n".format(page_path)
+            message += "Check overwrite files if it's not an error.\n"
+        return message
+
+    def show_child_layers(self):
+        # Done once here instead of inside each layer document
+        for info in self.layer_index.existing_layers():
+            element = info.element
+            if "style" not in element.attrib:
+                continue
+            element.attrib["style"] = "display:inline"
 
     def create_base_export_document(self):
         doc = copy.deepcopy(self.working_doc)
@@ -707,60 +3402,292 @@ class BatchExporter(inkex.EffectExtension):
 
         return command
 
-    def construct_thread(self, doc, base_command, use_logging, child_visible):
-        def export_layer_threaded(layer_export):
-            export_doc = copy.deepcopy(doc)
+    def construct_thread(
+        self,
+        serializer,
+        base_command,
+        supervisor,
+        shell_pool=None,
+        cache=None,
+        rasterizer=None,
+        layer_index=None,
+        layers_files=None,
+        layers_frames=None,
+        transport="file",
+        journal=None,
+    ):
+        def resolution_command(resolution):
+            command = base_command.copy()
+            if resolution != None:
+                # The arguments are kept by a shell, the others are reset
+                command += resolution.command_arguments(reset=shell_pool != None)
+            return command
 
+        def export_layer_threaded(layer_export):
+            """Results of the files of the layer, one by resolution"""
             path, (layer, _, _) = layer_export
-            copy_layer = copy.deepcopy(layer)
 
-            # Add the layer inside fresh document
+            # Wall clock, to be compared between processes
+            start = time.time()
+            step_start = time.perf_counter()
+
+            # Add the layer inside fresh document, without copying the base one
             # TODO doesn't handle layer styling
-            root = export_doc.getroot()
+            transform = None
+            if layer_index != None:
+                transform = layer_index.get(layer).transform
+            frame = None
+            if layers_frames != None:
+                frame = layers_frames.get(path)
+            export_data = serializer.serialize(layer, transform, frame)
+            prepare = time.perf_counter() - step_start
+
+            # The layer document is shared by the files of its resolutions
+            files = [(None, path)]
+            if layers_files != None and path in layers_files:
+                files = layers_files[path]
+
+            results = []
+            files_todo = []
+            for resolution, file_path in files:
+                result = {
+                    "path": file_path,
+                    "layer": path,
+                    "hash": None,
+                    "cached": False,
+                    "error": None,
+                    "start": start,
+                    "timings": {"prepare": prepare if results == [] else 0},
+                }
+                results.append(result)
+
+                # Skip the export if the same document have been already exported
+                if cache != None:
+                    if resolution == None:
+                        result["hash"] = cache.layer_hash(export_data)
+                    else:
+                        result["hash"] = cache.layer_hash(
+                            export_data,
+                            " ".join(resolution.command_arguments()).encode("utf-8"),
+                        )
+                    if cache.is_up_to_date(file_path, result["hash"]):
+                        logging.debug("  Cached: {}".format(file_path))
+                        result["cached"] = True
+                        continue
 
-            # Handle transform hierarchy
-            container = Layer.new("root")
-            parent = layer.getparent()
-            if parent != None:
-                container.transform = parent.composed_transform()
-            root.append(container)
+                # Before the file is written, for a resume if it is interrupted
+                if journal != None:
+                    journal.record([file_path])
+
+                if rasterizer != None:
+                    step_start = time.perf_counter()
+                    # Create the output folder if it doesn't exist
+                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                    if rasterizer.export(export_data, file_path, resolution):
+                        logging.debug("  {} (native)\n".format(file_path))
+                        result["timings"]["render"] = time.perf_counter() - step_start
+                        continue
+                    logging.debug("  Fallback to inkscape: {}".format(file_path))
+
+                files_todo.append((resolution, result))
+
+            # Sent on Inkscape input, a temporary file only if it failed
+            if transport == "pipe" and shell_pool == None:
+                files_failed = []
+                for resolution, result in files_todo:
+                    step_start = time.perf_counter()
+                    result["error"] = self.export_to_pipe(
+                        resolution_command(resolution),
+                        export_data,
+                        result["path"],
+                        supervisor,
+                    )
+                    result["timings"]["subprocess"] = time.perf_counter() - step_start
+                    if result["error"] != None:
+                        logging.debug(
+                            "  Fallback to temporary file: {}".format(result["path"])
+                        )
+                        files_failed.append((resolution, result))
+                files_todo = files_failed
+
+            if files_todo == []:
+                return results
 
-            copy_layer.attrib["style"] = "display:inline"
-            container.append(copy_layer)
+            # Save the data in a temporary file
+            step_start = time.perf_counter()
+            temporary_path = write_temporary_document(export_data, transport != "file")
+            try:
+                files_todo[0][1]["timings"]["serialize"] = (
+                    time.perf_counter() - step_start
+                )
 
-            svg_layers = export_doc.xpath(
-                '//svg:g[@inkscape:groupmode="layer"]', namespaces=inkex.NSS
-            )
+                for resolution, result in files_todo:
+                    step_start = time.perf_counter()
+                    if shell_pool != None:
+                        result["error"] = self.export_to_shell(
+                            shell_pool,
+                            resolution_command(resolution),
+                            temporary_path,
+                            result["path"],
+                            supervisor,
+                        )
+                    else:
+                        result["error"] = self.export_to_file(
+                            resolution_command(resolution),
+                            temporary_path,
+                            result["path"],
+                            supervisor,
+                        )
+                    result["timings"]["subprocess"] = time.perf_counter() - step_start
+            finally:
+                os.remove(temporary_path)
+
+            return results
 
-            if child_visible:
-                for element in svg_layers:
-                    if "style" not in element.attrib:
-                        continue
-                    element.attrib["style"] = "display:inline"
+        return export_layer_threaded
 
-            # self._debug_svg_doc_wait(export_doc)
+    def export_single_document(
+        self,
+        doc,
+        base_command,
+        layers_export,
+        supervisor,
+        cache=None,
+        transport="file",
+        journal=None,
+    ):
+        """Return the results of the layers, as the other engines"""
+        export_doc = copy.deepcopy(doc)
+        root = export_doc.getroot()
+
+        # A layer document is the base document with the layer container
+        base_data = etree.tostring(export_doc) if cache != None else None
+        layers_hash = {}
+        exported_paths = []
+        files_result = []
+        export_start = time.time()
 
-            # Save the data in a temporary file
-            with tempfile.NamedTemporaryFile(
-                delete=False, suffix=".svg"
-            ) as temporary_file:
+        # Every layer is added hidden, the actions show it only for its export
+        actions = command_to_actions(base_command)
+        for index, (path, (layer, _, _)) in enumerate(layers_export.items()):
+            container_id = "batch-export-layer-{}".format(index)
 
-                export_doc.write(temporary_file.name)
-                temporary_file.close()
+            # Same container as a layer document (see construct_thread)
+            container = Layer.new("root")
+            container.set("id", container_id)
+            container.transform = self.layer_index.get(layer).transform
+
+            if path in self.layers_frames:
+                copy_layer = self.layers_frames[path].copy_layer(layer)
+            else:
+                copy_layer = copy.deepcopy(layer)
+            copy_layer.attrib["style"] = "display:inline"
+            container.append(copy_layer)
 
-                self.export_to_file(
-                    base_command.copy(),
-                    temporary_file.name,
-                    path,
-                    use_logging,
+            # Skip the export if the same layer have been already exported
+            # Hashed before being added, ids of copies are not renamed yet
+            if cache != None:
+                layers_hash[path] = cache.layer_hash(
+                    base_data, etree.tostring(container)
                 )
+                if cache.is_up_to_date(path, layers_hash[path]):
+                    logging.debug("  Cached: {}".format(path))
+                    files_result.append(
+                        {
+                            "path": path,
+                            "layer": path,
+                            "hash": layers_hash[path],
+                            "cached": True,
+                            "error": None,
+                            "start": export_start,
+                            "timings": {},
+                        }
+                    )
+                    continue
+
+            container.attrib["style"] = "display:none"
+            root.append(container)
 
-            os.remove(temporary_file.name)
-            return True
+            # Create the output folder if it doesn't exist
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            logging.debug("  {} (actions)".format(path))
+            exported_paths.append(path)
+
+            actions += [
+                "select-by-id:{}".format(container_id),
+                "object-set-attribute:style,display:inline",
+                "export-filename:{}".format(path),
+                "export-do",
+                "object-set-attribute:style,display:none",
+                "select-clear",
+            ]
+
+        # Removed even if the export raised
+        document_path = write_temporary_document(
+            etree.tostring(export_doc), transport != "file"
+        )
+        try:
+            # Can't use delete=True, delete_on_close=False, since Inkscape use python 2.7
+            with tempfile.NamedTemporaryFile(
+                "w", delete=False, suffix=".txt", encoding="utf-8"
+            ) as actions_file:
+                try:
+                    # Through a file, the list would exceed command line limits
+                    actions_file.write(";".join(actions))
+                    actions_file.close()
+
+                    command = [
+                        "inkscape",
+                        "--batch-process",
+                        "--actions-file={}".format(actions_file.name),
+                        document_path,
+                    ]
+                    logging.debug("  {}\n".format(command))
+                    error = None
+                    subprocess_start = time.perf_counter()
+                    if exported_paths and journal != None:
+                        journal.record(exported_paths)
+                    if exported_paths:
+                        error = supervisor.run(
+                            command,
+                            exported_paths,
+                            timeout=supervisor.timeout * len(exported_paths),
+                        )
+                    subprocess_duration = time.perf_counter() - subprocess_start
+                finally:
+                    os.remove(actions_file.name)
+        finally:
+            os.remove(document_path)
+
+        # Only the missing files have failed, the duration is shared
+        for path in exported_paths:
+            files_result.append(
+                {
+                    "path": path,
+                    "layer": path,
+                    "hash": layers_hash.get(path),
+                    "cached": False,
+                    "error": (
+                        error
+                        if error != None
+                        and (not os.path.exists(path) or os.path.getsize(path) == 0)
+                        else None
+                    ),
+                    "start": export_start,
+                    "timings": {
+                        "subprocess": subprocess_duration / len(exported_paths)
+                    },
+                }
+            )
 
-        return export_layer_threaded
+        if cache != None:
+            for result in files_result:
+                if not result["cached"] and result["error"] == None:
+                    cache.update(result["path"], result["hash"])
+        return files_result
 
-    def export_to_file(self, command, svg_path, output_path, use_logging):
+    def export_to_file(self, command, svg_path, output_path, supervisor):
+        """Return the error if the export failed"""
         command.append("--export-filename=%s" % output_path)
         command.append(svg_path)
         logging.debug("  {}\n{}\n".format(output_path, command))
@@ -768,58 +3695,176 @@ class BatchExporter(inkex.EffectExtension):
         # Create the output folder if it doesn't exist
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
-        try:
-            if use_logging:
-                # If not piped, stdout and stderr will be showed in an inkscape dialog at the end.
-                # Inkscape export will create A LOT of warnings, most of them repeated, and I believe
-                # it is pointless to crowd the log file with these warnings.
-                with subprocess.Popen(command) as proc:
-                    proc.wait(timeout=300)
-            else:
-                with subprocess.Popen(
-                    command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-                ) as proc:
-                    proc.wait(timeout=300)
-        except OSError:
-            user_error(
-                "OS Error exporting", "Error while exporting file {}.".format(command)
-            )
+        return supervisor.run(command, [output_path])
 
-    def export_manifest(self, layer_exports, output_path):
-        json_root = []
-        for path, (_, hierarchy, counter) in layer_exports.items():
-            json_element, all_children = self.create_json_elements(json_root, hierarchy)
-            json_root = all_children
+    def export_to_pipe(self, command, export_data, output_path, supervisor):
+        """Return the error if the export failed"""
+        command.append("--export-filename=%s" % output_path)
+        command.append("--pipe")
+        logging.debug("  {}\n{} (pipe)\n".format(output_path, command))
 
-            json_element["path"] = path
-            json_element["order"] = counter
+        # Create the output folder if it doesn't exist
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+        return supervisor.run(command, [output_path], input_data=export_data)
+
+    def export_to_shell(self, shell_pool, command, svg_path, output_path, supervisor):
+        """Return the error if the export failed"""
+        logging.debug("  {}\n{} (shell)\n".format(output_path, command))
+
+        # Create the output folder if it doesn't exist
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+        error = shell_pool.export(command, svg_path, output_path)
+        if error == None:
+            return None
+
+        # Failed in the shell, export this layer with its own process
+        logging.debug(
+            "  Fallback to process export: {} ({})".format(output_path, error)
+        )
+        return self.export_to_file(command, svg_path, output_path, supervisor)
+
+    def export_manifest(
+        self, layer_exports, output_path, compact=False, layers_extras=None
+    ):
+        json_root = self.build_manifest(layer_exports, layers_extras)
 
         manifest_path = os.path.join(output_path, "manifest.json")
         logging.debug("  Export manifest to {}\n".format(manifest_path))
-        with open(manifest_path, "w+", encoding="utf-8") as f:
-            json.dump(json_root, f, ensure_ascii=False, indent=4)
 
-    def create_json_elements(self, parent_children, hierarchy, parent=None):
-        if hierarchy == []:
-            return (parent, parent_children)
+        # Replaced at once, the manifest stays valid if the export is stopped
+        os.makedirs(output_path, exist_ok=True)
+        temporary_path = manifest_path + ".tmp"
+        with open(temporary_path, "w+", encoding="utf-8") as f:
+            # json.dump write the elements as they are encoded
+            if compact:
+                json.dump(json_root, f, ensure_ascii=False, separators=(",", ":"))
+            else:
+                json.dump(json_root, f, ensure_ascii=False, indent=4)
+        os.replace(temporary_path, manifest_path)
+
+    def read_previous_manifest(self, output_path):
+        """Elements of a previous manifest, None if not found"""
+        manifest_path = os.path.join(output_path, "manifest.json")
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                json_elements = json.load(f)
+        except (OSError, ValueError):
+            logging.debug("  No previous manifest at {}".format(manifest_path))
+            return None
+
+        elements = []
+        while json_elements:
+            json_element = json_elements.pop()
+            json_elements += json_element["children"]
+            elements.append(json_element)
+        return elements
+
+    def get_resumed_paths(self, output_path, journal=None):
+        """Files exported by a previous export, and all the files it has written"""
+        paths = set()
+        # Failed or interrupted files can be replaced, they are exported again
+        files = journal.read() if journal != None else set()
+        for json_element in self.read_previous_manifest(output_path) or []:
+            layer_files = list(json_element.get("resolutions", {}).values())
+            if "path" in json_element:
+                layer_files.append(json_element["path"])
+            files.update(layer_files)
+            if "error" not in json_element:
+                paths.update(path for path in layer_files if os.path.exists(path))
+        return paths, files
+
+    def get_previous_atlas_paths(self, output_path):
+        """Atlas pages listed in a previous manifest"""
+        json_elements = self.read_previous_manifest(output_path)
+        return {
+            os.path.normpath(json_element["atlas"]["path"])
+            for json_element in json_elements or []
+            if "atlas" in json_element
+        }
+
+    def build_manifest(self, layer_exports, layers_extras=None):
+        json_root = []
+        layers_extras = layers_extras or {}
+
+        # Children of each element by name, a layer is inserted in O(depth)
+        root_index = {}
 
-        element_name = hierarchy[0]
-        ancestors = hierarchy[1:]
+        for path, (_, hierarchy, counter) in layer_exports.items():
+            children, children_index = json_root, root_index
+            for element_name in hierarchy:
+                if element_name not in children_index:
+                    json_element = {"name": element_name, "children": []}
+                    children.append(json_element)
+                    children_index[element_name] = (json_element, {})
 
-        json_element = next(
-            (el for el in parent_children if el["name"] == element_name), None
-        )
+                json_element, children_index = children_index[element_name]
+                children = json_element["children"]
 
-        if json_element == None:
-            json_element = {"name": element_name, "children": []}
-            parent_children.append(json_element)
+            json_element["path"] = path
+            json_element["order"] = counter
+            json_element.update(layers_extras.get(path, {}))
+
+        return json_root
+
+
+# State of a worker process, see BatchExporter.export_process_pool
+_process_worker = {}
+
+
+def _init_process_worker(
+    document_data,
+    serializer,
+    base_command,
+    supervisor,
+    log_file,
+    engine,
+    cache,
+    rasterizer,
+    layers_files,
+    layers_frames,
+    transport,
+    journal,
+):
+    # Processes started with spawn don't inherit the logging configuration
+    if log_file != None:
+        logging.basicConfig(filename=log_file, level=logging.DEBUG)
+
+    document = inkex.load_svg(io.BytesIO(document_data))
+    layer_index = LayerIndex(document)
+    _process_worker["layers"] = [info.element for info in layer_index.layers]
+    layers_frames = {
+        path: frame.with_layers(_process_worker["layers"])
+        for path, frame in layers_frames.items()
+    }
+
+    shell_pool = None
+    if engine == "shell":
+        shell_pool = InkscapeShellPool(1, supervisor.use_logging, supervisor.timeout)
+        multiprocessing.util.Finalize(None, shell_pool.close, exitpriority=10)
+
+    _process_worker["export_layer"] = BatchExporter().construct_thread(
+        serializer,
+        base_command,
+        supervisor,
+        shell_pool,
+        cache,
+        rasterizer,
+        layer_index,
+        layers_files,
+        layers_frames,
+        transport,
+        journal,
+    )
 
-        (leaf, children) = self.create_json_elements(
-            json_element["children"], ancestors, json_element
-        )
-        json_element["children"] = children
 
-        return (leaf, parent_children)
+def _export_layers_process(tasks):
+    results = []
+    for path, (layer_position, hierarchy, counter) in tasks:
+        layer = _process_worker["layers"][layer_position]
+        results += _process_worker["export_layer"]((path, (layer, hierarchy, counter)))
+    return results
 
 
 def _main():
@@ -0,0 +1,176 @@
+#! /usr/bin/env python
+
+"""Export the layers of several SVG files without the Inkscape interface.
+
+The options are the ones of the extension (see batch_export.inx), given by a
+JSON config file and/or --set. The files are exported at the same time, their
+layers sharing one pool of threads (--threads), which is also used by the
+actions engine and the PNG post-processing. pool-type=process falls back to
+these threads, and scheduling=auto only orders the layers.
+
+    python batch_export_cli.py --config preset.json --set path=export/[FILE] a.svg b.svg
+
+Exit status: 0 all layers exported, 1 some layers failed, 2 wrong config or
+arguments, 3 some input files couldn't be exported.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import io
+import json
+import logging
+import os
+import sys
+
+import batch_export
+
+EXIT_OK = 0
+EXIT_LAYERS_FAILED = 1
+EXIT_CONFIG_ERROR = 2
+EXIT_INPUT_ERROR = 3
+
+
+def load_config(config_path, overrides):
+    """Extension arguments from the config file and the --set values"""
+    config = {}
+    if config_path:
+        with open(config_path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        if not isinstance(config, dict):
+            raise ValueError("the config must be a JSON object")
+
+    for override in overrides:
+        name, separator, value = override.partition("=")
+        if not separator:
+            raise ValueError("--set {} is not name=value".format(override))
+        config[name] = value
+
+    arguments = []
+    for name, value in config.items():
+        # Booleans are strings for the extension, as given by Inkscape
+        if isinstance(value, bool):
+            value = "true" if value else "false"
+        arguments.append("--{}={}".format(name, value))
+    return arguments
+
+
+def check_arguments(arguments):
+    """Raise ValueError on unknown options or invalid values"""
+    exporter = batch_export.BatchExporter()
+    parser = exporter.arg_parser
+    parser.exit_on_error = False
+    try:
+        exporter.options, unknown = parser.parse_known_args(arguments)
+    except argparse.ArgumentError as error:
+        raise ValueError(str(error))
+    if unknown:
+        raise ValueError("unknown options {}".format(" ".join(unknown)))
+
+    # Same checks as each export (resolutions, name template), before any file
+    try:
+        exporter.check_options(batch_export.Options(exporter))
+    except SystemExit:
+        # Raised by user_error, the message has already been written
+        raise ValueError("invalid options")
+
+
+def file_arguments(arguments, input_path):
+    """[FILE] in the export path is replaced by the input file name"""
+    name = os.path.splitext(os.path.basename(input_path))[0]
+    return [argument.replace("[FILE]", name) for argument in arguments] + [input_path]
+
+
+def export_file(input_path, arguments, executor):
+    """Return the exit status of the file"""
+    exporter = batch_export.BatchExporter(executor)
+    try:
+        exporter.run(file_arguments(arguments, input_path), output=io.BytesIO())
+    except SystemExit:
+        # Raised by user_error, the message has already been written
+        return EXIT_INPUT_ERROR
+    except Exception:
+        logging.exception("Export of {} failed".format(input_path))
+        return EXIT_INPUT_ERROR
+
+    if exporter.layers_error:
+        return EXIT_LAYERS_FAILED
+    return EXIT_OK
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        epilog="Exit status: 0 all layers exported, 1 some layers failed, "
+        "2 wrong config or arguments, 3 some input files couldn't be exported.",
+    )
+    parser.add_argument("inputs", nargs="+", help="SVG files to export")
+    parser.add_argument("--config", help="JSON object of extension options")
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="extension option, overrides the config",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=min(4, os.cpu_count() or 1),
+        help="files prepared at the same time, their exports share --threads",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=8, help="layers exported at the same time"
+    )
+    parser.add_argument("--verbose", action="store_true", help="log on stderr")
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG, stream=sys.stderr)
+
+    try:
+        arguments = load_config(args.config, args.set)
+        check_arguments(arguments)
+    except (OSError, ValueError) as error:
+        print("Config error: {}".format(error), file=sys.stderr)
+        return EXIT_CONFIG_ERROR
+
+    missing = [path for path in args.inputs if not os.path.isfile(path)]
+    for path in missing:
+        print("Input not found: {}".format(path), file=sys.stderr)
+    inputs = [path for path in args.inputs if path not in missing]
+
+    statuses = {path: EXIT_INPUT_ERROR for path in missing}
+    with ThreadPoolExecutor(max_workers=args.threads) as layers_executor:
+        with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as files_executor:
+            futures = {
+                path: files_executor.submit(
+                    export_file, path, arguments, layers_executor
+                )
+                for path in inputs
+            }
+            for path, future in futures.items():
+                statuses[path] = future.result()
+
+    for path in args.inputs:
+        print(
+            "{}: {}".format(
+                path,
+                {
+                    EXIT_OK: "exported",
+                    EXIT_LAYERS_FAILED: "some layers failed",
+                    EXIT_INPUT_ERROR: "not exported",
+                }[statuses[path]],
+            ),
+            file=sys.stderr,
+        )
+
+    # The worst status
+    if EXIT_INPUT_ERROR in statuses.values():
+        return EXIT_INPUT_ERROR
+    if EXIT_LAYERS_FAILED in statuses.values():
+        return EXIT_LAYERS_FAILED
+    return EXIT_OK
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,288 @@
+#! /usr/bin/env python
+
+"""Measure the export throughput on synthetic models, without Inkscape.
+
+Generate models with the given number of layers, nesting depth, clones and
+embedded image size, and export them with a fake "inkscape" put first in the
+PATH. The fake one only waits the simulated startup and render durations and
+copies the layer document. The duration of each step of BatchExporter.effect
+is written as JSON.
+
+    python test/benchmark.py --layers 10 100 300 --output bench.json
+
+With --check-cache, each model is exported twice with the cache, and the
+second export must find every layer in it (the exit code is 1 otherwise).
+"""
+
+import argparse
+import base64
+import io
+import json
+import os
+import random
+import stat
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import batch_export
+
+# Fake inkscape, the durations are given by the environment
+FAKE_INKSCAPE = """
+import os
+import sys
+import time
+
+STARTUP = float(os.environ.get("FAKE_INKSCAPE_STARTUP", "0"))
+RENDER = float(os.environ.get("FAKE_INKSCAPE_RENDER", "0"))
+
+
+def export(svg_path, output_path):
+    time.sleep(RENDER)
+    # Without a file, the document is given on the input (--pipe)
+    if svg_path == None:
+        data = sys.stdin.buffer.read()
+    else:
+        with open(svg_path, "rb") as source:
+            data = source.read()
+    with open(output_path, "wb") as output:
+        output.write(data)
+
+
+def run_actions(actions, state):
+    for action in actions.split(";"):
+        name, _, value = action.strip().partition(":")
+        if name == "file-open":
+            state["file"] = value
+        elif name == "export-filename":
+            state["output"] = value
+        elif name == "export-do":
+            export(state["file"], state["output"])
+
+
+args = sys.argv[1:]
+time.sleep(STARTUP)
+state = {"file": next((a for a in args if not a.startswith("-")), None)}
+
+if "--shell" in args:
+    sys.stdout.write("> ")
+    sys.stdout.flush()
+    for line in sys.stdin:
+        if line.strip() == "quit":
+            break
+        run_actions(line, state)
+        sys.stdout.write("> ")
+        sys.stdout.flush()
+    sys.exit(0)
+
+for arg in args:
+    if arg.startswith("--actions-file="):
+        with open(arg.split("=", 1)[1], encoding="utf-8") as f:
+            run_actions(f.read(), state)
+    elif arg.startswith("--export-filename="):
+        export(state["file"], arg.split("=", 1)[1])
+"""
+
+
+def install_fake_inkscape(folder):
+    script_path = os.path.join(folder, "fake_inkscape.py")
+    with open(script_path, "w", encoding="utf-8") as f:
+        f.write(FAKE_INKSCAPE)
+
+    if sys.platform == "win32":
+        with open(os.path.join(folder, "inkscape.bat"), "w") as f:
+            f.write('@"{}" "{}" %*\n'.format(sys.executable, script_path))
+    else:
+        launcher = os.path.join(folder, "inkscape")
+        with open(launcher, "w") as f:
+            f.write(
+                '#!/bin/sh\nexec "{}" "{}" "$@"\n'.format(sys.executable, script_path)
+            )
+        os.chmod(launcher, os.stat(launcher).st_mode | stat.S_IEXEC)
+
+    os.environ["PATH"] = folder + os.pathsep + os.environ["PATH"]
+
+
+def generate_model(path, nb_layers, depth, nb_clones, image_size, seed=0):
+    """Leaf layers are spread in branches of nested layers"""
+    rng = random.Random(seed)
+    lines = [
+        '<svg xmlns="http://www.w3.org/2000/svg"'
+        ' xmlns:xlink="http://www.w3.org/1999/xlink"'
+        ' xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape"'
+        ' width="512" height="512" viewBox="0 0 512 512">',
+        "<defs>",
+        '<linearGradient id="gradient"><stop offset="0" stop-color="#f00"/>'
+        '<stop offset="1" stop-color="#00f"/></linearGradient>',
+    ]
+    if image_size > 0:
+        data = base64.b64encode(rng.randbytes(image_size)).decode("ascii")
+        lines.append(
+            '<pattern id="texture" width="64" height="64"'
+            ' patternUnits="userSpaceOnUse"><image width="64" height="64"'
+            ' xlink:href="data:image/png;base64,{}"/></pattern>'.format(data)
+        )
+    lines.append("</defs>")
+
+    # Sources of the clones, ignored for export
+    lines.append(
+        '<g inkscape:groupmode="layer" inkscape:label="_Sources" id="sources">'
+        '<path id="source-0" d="M 0,0 L 10,0 L 10,10 Z" fill="url(#gradient)"/>'
+        '<use id="source-1" xlink:href="#source-0" transform="translate(5,5)"/>'
+        "</g>"
+    )
+
+    nb_branches = max(1, nb_layers // 8)
+    for branch in range(nb_branches):
+        for level in range(depth):
+            lines.append(
+                '<g inkscape:groupmode="layer" inkscape:label="Branch {}-{}"'
+                ' id="branch-{}-{}" transform="translate({},{})">'.format(
+                    branch, level, branch, level, level, level
+                )
+            )
+        for leaf in range(branch, nb_layers, nb_branches):
+            lines.append(
+                '<g inkscape:groupmode="layer" inkscape:label="Layer {}"'
+                ' id="layer-{}">'.format(leaf, leaf)
+            )
+            x, y = rng.uniform(0, 500), rng.uniform(0, 500)
+            lines.append(
+                '<path d="M {0},{1} L {2},{1} L {2},{3} Z" fill="#{4:06x}"/>'.format(
+                    x, y, x + 10, y + 10, rng.randrange(0xFFFFFF)
+                )
+            )
+            if image_size > 0:
+                lines.append(
+                    '<rect x="{}" y="{}" width="64" height="64"'
+                    ' fill="url(#texture)"/>'.format(x, y)
+                )
+            for clone in range(nb_clones):
+                lines.append(
+                    '<use xlink:href="#source-{}" x="{}" y="{}"/>'.format(
+                        clone % 2, x + clone, y
+                    )
+                )
+            lines.append("</g>")
+        lines.append("</g>" * depth)
+
+    lines.append("</svg>")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+
+
+def run_export(svg_path, output_path, args, extra_args=()):
+    exporter = batch_export.BatchExporter()
+    start = time.perf_counter()
+    exporter.run(
+        list(extra_args)
+        + [
+            "--path={}".format(output_path),
+            "--export-type={}".format(args.export_type),
+            "--export-engine={}".format(args.engine),
+            "--pool-type={}".format(args.pool_type),
+            "--export-transport={}".format(args.transport),
+            "--number-threads={}".format(args.threads),
+            "--chunks-size={}".format(args.chunks_size),
+            "--name-template=[NUM]_[HIERARCHY]_[LAYER_NAME]",
+            "--overwrite-files=true",
+            svg_path,
+        ],
+        output=io.BytesIO(),
+    )
+    total = time.perf_counter() - start
+    return {"total": total, "phases": exporter.phases_timings}
+
+
+def check_cache(svg_path, output_path, args):
+    """Layers cached by a second identical export, and the number of layers"""
+    cache_args = ["--use-cache=true", "--export-timings=true"]
+    for _ in range(2):
+        run_export(svg_path, output_path, args, cache_args)
+    with open(os.path.join(output_path, "timings.json"), encoding="utf-8") as f:
+        layers_timings = json.load(f)["layers"]
+    cached = [path for path, timings in layers_timings.items() if timings["cached"]]
+    return len(cached), len(layers_timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--layers", type=int, nargs="+", default=[10, 50, 100])
+    parser.add_argument("--depth", type=int, default=2)
+    parser.add_argument("--clones", type=int, default=2)
+    parser.add_argument("--image-size", type=int, default=0, help="bytes")
+    parser.add_argument("--startup", type=float, default=0.2, help="seconds")
+    parser.add_argument("--render", type=float, default=0.05, help="seconds")
+    parser.add_argument("--export-type", default="png")
+    parser.add_argument("--engine", default="process")
+    parser.add_argument("--pool-type", default="thread")
+    parser.add_argument("--transport", default="file")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--chunks-size", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--output", help="JSON file, stdout otherwise")
+    parser.add_argument(
+        "--check-cache",
+        action="store_true",
+        help="check that a second identical export caches every layer",
+    )
+    args = parser.parse_args()
+
+    if args.check_cache:
+        failed = False
+        with tempfile.TemporaryDirectory() as folder:
+            install_fake_inkscape(folder)
+            for nb_layers in args.layers:
+                svg_path = os.path.join(folder, "model-{}.svg".format(nb_layers))
+                generate_model(
+                    svg_path, nb_layers, args.depth, args.clones, args.image_size
+                )
+                output_path = os.path.join(folder, "cache-{}".format(nb_layers))
+                cached, total = check_cache(svg_path, output_path, args)
+                print(
+                    "{} layers: {}/{} cached".format(nb_layers, cached, total),
+                    file=sys.stderr,
+                )
+                failed = failed or cached != total
+        sys.exit(1 if failed else 0)
+
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        install_fake_inkscape(folder)
+        os.environ["FAKE_INKSCAPE_STARTUP"] = str(args.startup)
+        os.environ["FAKE_INKSCAPE_RENDER"] = str(args.render)
+
+        for nb_layers in args.layers:
+            svg_path = os.path.join(folder, "model-{}.svg".format(nb_layers))
+            generate_model(
+                svg_path, nb_layers, args.depth, args.clones, args.image_size
+            )
+            for run in range(args.repeat):
+                output_path = os.path.join(
+                    folder, "export-{}-{}".format(nb_layers, run)
+                )
+                result = run_export(svg_path, output_path, args)
+                result.update({"layers": nb_layers, "run": run})
+                results.append(result)
+                print(
+                    "{} layers: {:.3f}s".format(nb_layers, result["total"]),
+                    file=sys.stderr,
+                )
+
+    report = {
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "python": sys.version.split()[0],
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#! /usr/bin/env python
+
+"""Compare the native PNG engine with Inkscape on the Pickle model.
+
+Export test/pickle/PickleSVG.svg in PNG with both engines and compare the
+files pixel by pixel. Need Inkscape in the PATH, cairosvg, Pillow and numpy.
+
+    python test/pixel_diff.py [--tolerance 16] [--max-ratio 0.01]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL = os.path.join(ROOT, "test", "pickle", "PickleSVG.svg")
+
+
+def export(engine, output_path):
+    command = [
+        sys.executable,
+        os.path.join(ROOT, "batch_export.py"),
+        "--export-type=png",
+        "--export-engine={}".format(engine),
+        "--path={}".format(output_path),
+        "--name-template=[NUM]_[LAYER_NAME]",
+        "--overwrite-files=true",
+        MODEL,
+    ]
+    subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+
+
+def compare(reference_path, native_path, tolerance):
+    reference = numpy.asarray(Image.open(reference_path).convert("RGBA"), numpy.int16)
+    native = numpy.asarray(Image.open(native_path).convert("RGBA"), numpy.int16)
+    if reference.shape != native.shape:
+        return None
+    difference = numpy.abs(reference - native).max(axis=2)
+    return numpy.count_nonzero(difference > tolerance) / difference.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--tolerance", type=int, default=16, help="channel difference ignored"
+    )
+    parser.add_argument(
+        "--max-ratio", type=float, default=0.01, help="ratio of pixels allowed"
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        reference_path = os.path.join(folder, "inkscape")
+        native_path = os.path.join(folder, "native")
+        export("process", reference_path)
+        export("native", native_path)
+
+        failed = False
+        for name in sorted(os.listdir(reference_path)):
+            if not name.endswith(".png"):
+                continue
+            ratio = compare(
+                os.path.join(reference_path, name),
+                os.path.join(native_path, name),
+                args.tolerance,
+            )
+            if ratio == None:
+                print("{}: different sizes".format(name))
+                failed = True
+                continue
+            print("{}: {:.2%} pixels differ".format(name, ratio))
+            failed |= ratio > args.max_ratio
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())